@@ -1,8 +1,7 @@
 
+import atexit
 import os
 import sys
-from datetime import datetime
-from threading import Lock
 
 from flask import (
     Flask,
@@ -12,32 +11,114 @@ from flask import (
     make_response,
     redirect,
 )
-import pandas as pd
 
 sys.path.append('../scripts')
-from features import StocksFeatures
+from features import (
+    KERNELS,
+    PEARSON,
+    StocksFeatures,
+)
+from pagerank import PageRankTable
 from graph import (
-    Session as nSession
+    GRAPH_VERSION,
+    Session as nSession,
+    close_drivers,
+)
+from graph.membership import MembershipIndex
+from heatmap import (
+    TILE_FORMATS,
+    TILE_SIZE,
+    encode_tile,
+    num_tiles,
+    tile_values,
+)
+from responses import cached_response
+from snapshot import (
+    Snapshot,
+    SnapshotReloader,
+    source_stamp,
+    stamp_version,
+)
+from service import (
+    ServiceError,
+    SimilarityService,
+    columnar,
+    encode_columnar,
+    prefers_columnar,
+    process_algo_name,
 )
-
-## Constants
-PAGE_RANK = 'page_rank'
-LOUVAIN = 'louvain'
-LEIDEN = 'leiden'
-
-ALGO_2_PROPERTY = {
-    PAGE_RANK: 'pageRank',
-    LOUVAIN: 'community',
-    LEIDEN: 'leiden_community',
-}
-
 
 ## Set up some objects before starting the app.
 TS_PATH = '../../data/current.csv'
-FEATURES = StocksFeatures.read_csv(TS_PATH)
-
-# Cache the pearson features.
-FEATURES.pearson()
+PRICES_PATH = '../../data/prices'
+if os.path.isdir(PRICES_PATH):
+    # Prefer the Parquet store written by fetch_stock_prices.py.
+    TS_PATH = PRICES_PATH
+ARTIFACTS_PATH = os.environ.get('ARTIFACTS_PATH', '../../data/artifacts')
+
+# Local personalized PageRank table, built by `make ppr`; when present it
+# answers page_rank requests instead of Neo4j GDS.
+EDGES_PATH = '../../data/pearson.csv'
+PPR_PATH = '../../data/ppr'
+
+## Neo4j: one pooled driver per process, a short-lived session per request.
+N4J_IP = os.environ.get('N4J_IP', None)
+atexit.register(close_drivers)
+
+def n4j_session():
+    return nSession.shared(N4J_IP)
+
+# Community memberships, kept in memory until the graph is rebuilt.
+MEMBERSHIP = MembershipIndex()
+
+def memberships(prop=None):
+    with n4j_session() as s:
+        return MEMBERSHIP.get(s, prop)
+
+def graph_version():
+    with n4j_session() as s:
+        return GRAPH_VERSION.get(s)
+
+def load_snapshot(stamp=None):
+    '''
+    Load the data into a new Snapshot, warmed up before it serves requests.
+    '''
+    # Memory-map the prices and pearson features; rebuilt when TS_PATH changes.
+    # Optionally limit the window, eg. WINDOW_START=2025-01-01
+    features = StocksFeatures.cached(TS_PATH, ARTIFACTS_PATH,
+                                     start=os.environ.get('WINDOW_START'))
+    ppr_table = None
+    if os.path.isdir(PPR_PATH):
+        ppr_table = PageRankTable.cached(EDGES_PATH, PPR_PATH)
+
+    def page_rank(ticker, n):
+        if ppr_table is not None and ticker in ppr_table:
+            return ppr_table.top(ticker, n)
+        with n4j_session() as s:
+            return s.cached_personalized_pagerank(ticker, top_n=n)
+
+    # The stamp covers the PageRank table's edges too, so a swap retires the
+    # cached responses even when the prices did not change.
+    service = SimilarityService(features, memberships, page_rank, graph_version,
+                               version=stamp_version(stamp))
+    # Everything a request would otherwise build on first use: ?w= windows,
+    # chart labels and the heatmap's ticker order (by name without Neo4j).
+    features.pearson()
+    features.windows()
+    service.labels()
+    service.heatmap_order()
+    return Snapshot(features, ppr_table, service, stamp)
+
+# The current dataset; swapped in the background when TS_PATH, PPR_PATH or
+# the EDGES_PATH it is built from change, see snapshot.SnapshotReloader and
+# RELOAD_SECONDS.
+SNAPSHOTS = SnapshotReloader(load_snapshot,
+                             lambda: source_stamp(TS_PATH, PPR_PATH, EDGES_PATH))
+SNAPSHOTS.start()
+atexit.register(SNAPSHOTS.stop)
+
+def current_service():
+    return SNAPSHOTS.current().service
 
 ## Flask application logic.
 app = Flask(__name__)
@@ -49,164 +130,110 @@ def default():
 
 @app.route("/<string:ticker>")
 def ticker(ticker):
-    ticker = ticker.upper()
-
-    with Lock():
-         tickers = FEATURES.df['Ticker'].unique()
-
+    service = current_service()
     graph_algo = request.args.get('a')
     n = int(request.args.get('n', 4))
-
-    data = None
-
-    if graph_algo is not None and "_G" in graph_algo:
-        # Call groups on algorithm
-
-        graph_algo = graph_algo[:-2]
-
-        data = api_ticker_groups(ticker, graph_algo, n).get_json()
-    else:
-        data = api_ticker_similar(ticker, graph_algo, n).get_json()
-
-    if not data:
-        return
-
-    if isinstance(data, dict):
-        data = [data]
-
-    if 'group' in data[0]:
-        groups_data = [group['ts'] for group in data]
-        time_series_data = [[{label : format_list_of_timeseries(time_series)} for label, time_series in group.items()] for group in groups_data]
-        timestamp_dates = [entry[0] for entry in list(time_series_data[0][0].values())[0]]
-        return render_template('main.html', ticker=ticker, labels=timestamp_dates, time_series_data=time_series_data, ticker_options=tickers, group_flag=True)
-
-    else:
-        data = data[0]
-        time_series_data = [{label : format_list_of_timeseries(time_series)} for label, time_series in data['ts'].items()]
-        timestamp_dates = [format_timeseries(entry[0]) for entry in list(data['ts'].items())[0][1]]
-
-        return render_template('main.html', ticker=ticker, labels=timestamp_dates, time_series_data=time_series_data, ticker_options=tickers, group_flag=False)
+    w = request.args.get('w')
+
+    try:
+        if graph_algo is not None and "_G" in graph_algo:
+            # Call groups on algorithm
+            results = service.groups(ticker, graph_algo[:-2], n)
+        else:
+            results = [service.similar(ticker, graph_algo, n, w)]
+    except ServiceError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+
+    charts = [service.chart(result.series) for result in results]
+    labels = charts[0][0]
+    group_flag = results[0].group is not None
+    time_series_data = [data for _, data in charts] if group_flag else charts[0][1]
+
+    return render_template('main.html', ticker=ticker.upper(), labels=labels,
+                           time_series_data=time_series_data,
+                           ticker_options=service.tickers(), group_flag=group_flag)
 
 @app.route("/stonks")
 def stonks():
-    df = None
-    with Lock():
-        names = FEATURES.names()
-        df = pd.DataFrame(FEATURES.pearson(), columns=names, index=names)
+    # Correlation heatmap, fetched tile by tile; see api_heatmap_tile
+    try:
+        meta = heatmap_meta(current_service())
+    except ServiceError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
 
-    return render_template('stonks.html', df=df)
+    return render_template('stonks.html', **meta)
 
 
 @app.route("/communities")
 def communities():
-    n4j_sess = nSession(os.environ['N4J_IP'])
-    res = n4j_sess.get_community()
+    values = memberships('community').assignments('community')
 
     return render_template('communities.html', header=['Ticker', 'Community ID'],
-                           values=res.values())
+                           values=values)
 
 #### API endpoints
 
 @app.route("/api/<string:ticker>/similar")
-def api_ticker_similar(ticker, algo = None, n = 0):
-    graph_algo = algo
-
-    if graph_algo is None:
-        graph_algo = request.args.get('a')
-
-    N = int(n)
-
-    if N == 0:
-        N = int(request.args.get('n', 6))
-
-    error = None
-    ticker = ticker.upper()
-    ts = None
-    rank = None
-
-    graph_algo = process_algo_name(graph_algo)
-
-    if graph_algo not in ALGO_2_PROPERTY:
-        # TODO: maybe return an error instead
-        graph_algo = LOUVAIN
-
-    with Lock():
-        if ticker not in FEATURES.nameset():
-            error = 'unknown stock ticker'
-
-    if error:
-        return make_response(jsonify({'error': error}), 400)
-
-    s = nSession(os.environ.get('N4J_IP', None))
-
-    if graph_algo == PAGE_RANK:
-        _similar = s.run_personalized_pagerank(ticker)
-        rank = [[_.get('ticker'), _.get('score')] for _ in _similar if _.get('score')]
-        filtered_similar = [_.get('ticker') for _ in _similar if _.get('score')][:N]
-        with Lock():
-            # Timeseries data
-            ts = FEATURES.ts_for_tickers(filtered_similar + [ticker])
-        out = {
-            'ticker': ticker,
-            'rank': [],
-        }
-        out.update(ts)
-
-        return make_response(jsonify(out), 200)
-
-    else:
-        # Otherwise use the community-based similarity based on a property.
-        prop = ALGO_2_PROPERTY[graph_algo]
-        similar = s.get_similar(ticker, nproperty=prop)
-
-    with Lock():
-        # Rank similar stocks, and trim to top N
-        rank = FEATURES.rank_tickers(ticker, similar, N)
-    filtered_similar = [_[0] for _ in rank]
-    with Lock():
-        # Timeseries data
-        ts = FEATURES.ts_for_tickers(filtered_similar + [ticker])
-    out = {
-        'ticker': ticker,
-        'rank': rank,
-    }
-    out.update(ts)
-
-    return make_response(jsonify(out), 200)
+def api_ticker_similar(ticker):
+    service = current_service()
+    graph_algo = process_algo_name(request.args.get('a'))
+    N = int(request.args.get('n', 6))
+    w = request.args.get('w')
+    fmt = wants_columnar()
+
+    def build():
+        result = service.similar(ticker, graph_algo, N, w)
+        if fmt:
+            return columnar_response(columnar([result]))
+        return make_response(jsonify(result.to_json()), 200)
+
+    return cached_response(service, ('similar', ticker.upper(), graph_algo, N, w, fmt), build,
+                           vary='Accept')
 
 @app.route("/api/<string:ticker>/groups")
-def api_ticker_groups(ticker, algo = None, n = 0):
-    graph_algo = algo
-
-    if graph_algo is None:
-        graph_algo = request.args.get('a')
-
-    N = n
-
-    if N == 0:
-        N = int(request.args.get('n', 6))
-
-    error = None
-    ticker = ticker.upper()
-
-    graph_algo = process_algo_name(graph_algo)
-
-    if graph_algo not in ALGO_2_PROPERTY:
-        # TODO: maybe return an error instead
-        graph_algo = LOUVAIN
-    with Lock():
-        if ticker not in FEATURES.nameset():
-            error = 'unknown stock ticker'
-    if error:
-        return make_response(jsonify({'error': error}), 400)
-
-    s = nSession(os.environ.get('N4J_IP', None))
-    prop = ALGO_2_PROPERTY[graph_algo]
-    groups = s.get_groups(ticker, nproperty=prop)
-    collected = FEATURES.collect_groups(ticker, groups, N)
-    with Lock():
-        ranked_ts = FEATURES.ts_ranked(ticker, collected, N)
-    return make_response(jsonify(ranked_ts), 200)
+def api_ticker_groups(ticker):
+    service = current_service()
+    graph_algo = process_algo_name(request.args.get('a'))
+    N = int(request.args.get('n', 6))
+    fmt = wants_columnar()
+
+    def build():
+        results = service.groups(ticker, graph_algo, N)
+        if fmt:
+            return columnar_response(columnar(results, grouped=True))
+        return make_response(jsonify([result.group_json() for result in results]), 200)
+
+    return cached_response(service, ('groups', ticker.upper(), graph_algo, N, fmt), build,
+                           vary='Accept')
+
+@app.route("/api/heatmap")
+def api_heatmap():
+    try:
+        return make_response(jsonify(heatmap_meta(current_service())), 200)
+    except ServiceError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+
+@app.route("/api/heatmap/<int:row>/<int:col>.<fmt>")
+def api_heatmap_tile(row, col, fmt):
+    service = current_service()
+    method = request.args.get('m', PEARSON).lower()
+    step = request.args.get('step')
+
+    def build():
+        if fmt not in TILE_FORMATS:
+            raise ServiceError(f'unknown tile format, one of {list(TILE_FORMATS)}')
+        zoom = service.check_step(step)
+        order, _ = service.heatmap_order()
+        tiles = num_tiles(len(order), zoom)
+        if not (0 <= row < tiles and 0 <= col < tiles):
+            raise ServiceError('tile out of range')
+        values = tile_values(service.correlation(method), order, row, col, zoom)
+        body, mimetype = encode_tile(values, fmt)
+        response = make_response(body, 200)
+        response.mimetype = mimetype
+        return response
+
+    return cached_response(service, ('heatmap', method, step, row, col, fmt), build)
 
 # So default HTTP call for favicon does not interfere with default route request parameters
 @app.route('/favicon.ico')
@@ -215,16 +242,35 @@ def favicon():
 
 #### Helper Functions
 
-def format_list_of_timeseries(timestamps):
-    return [[format_timeseries(entry[0]), entry[1]] for entry in timestamps]
-
-def format_timeseries(timestamp):
-    incoming_format = "%a, %d %b %Y %H:%M:%S GMT"
-    desired_format = "%m/%d/%y"
-    return datetime.strftime(datetime.strptime(timestamp, incoming_format), desired_format)
-
-def process_algo_name(algo):
-    if algo is not None:
-        return algo.lower()
+def heatmap_meta(service):
+    '''
+    What a client needs to lay out the heatmap tiles: ?m=<measure> picks the
+    correlation and ?step=<n> averages n x n blocks of tickers per cell.
+    '''
+    method = request.args.get('m', PEARSON).lower()
+    if method not in KERNELS:
+        raise ServiceError(f'unknown correlation, one of {list(KERNELS)}')
+    step = service.check_step(request.args.get('step'))
+    order, groups = service.heatmap_order()
+    names = service.tickers()
+    return {
+        'method': method,
+        'step': step,
+        'size': TILE_SIZE,
+        'tiles': num_tiles(len(order), step),
+        'tickers': [names[ix] for ix in order.tolist()],
+        'groups': groups,
+        'methods': list(KERNELS),
+    }
 
-    return algo
+def wants_columnar():
+    '''
+    ?format=columnar, or an Accept header naming COLUMNAR_MIMETYPE, see
+    service.prefers_columnar
+    '''
+    return prefers_columnar(request.args, request.accept_mimetypes)
+
+def columnar_response(payload):
+    response = make_response(encode_columnar(payload), 200)
+    response.mimetype = 'application/json'
+    return response
@@ -0,0 +1,99 @@
+'''
+Correlation heatmap tiles, so the browser fetches only the visible blocks
+of the matrix instead of the whole thing as an HTML table.
+
+Tickers are ordered by community; at zoom `step`, every tile cell is the
+mean of a step x step block of the reordered matrix.
+'''
+import struct
+import zlib
+
+import numpy as np
+
+
+# Cells per tile side.
+TILE_SIZE = 64
+TILE_FORMATS = ('png', 'bin')
+
+# Diverging colours for -1, 0 and 1, and for missing values.
+NEGATIVE = np.array([33, 102, 172], dtype=np.float64)
+NEUTRAL = np.array([247, 247, 247], dtype=np.float64)
+POSITIVE = np.array([178, 24, 43], dtype=np.float64)
+MISSING = np.array([200, 200, 200], dtype=np.uint8)
+
+
+def num_tiles(n, step=1, size=TILE_SIZE):
+    '''
+    Tiles per side for an n x n matrix at zoom `step`.
+    '''
+    cells = -(-n // step)
+    return max(1, -(-cells // size))
+
+
+def tile_values(corr, order, row, col, step=1, size=TILE_SIZE):
+    '''
+    corr: (n, n) correlation matrix.
+    order: matrix index of each heatmap position, eg. grouped by community.
+
+    Returns the float32 (<= size, <= size) tile at (row, col), only reading
+    its own block of `corr`.
+    '''
+    span = size * step
+    rows = order[row * span:(row + 1) * span]
+    cols = order[col * span:(col + 1) * span]
+    block = np.asarray(corr[np.ix_(rows, cols)], dtype=np.float32)
+    if step == 1:
+        return block
+    return downsample(block, step)
+
+
+def downsample(block, step):
+    '''
+    Mean of every step x step block, ignoring NaN; ragged edges pad with NaN.
+    '''
+    h, w = -(-block.shape[0] // step), -(-block.shape[1] // step)
+    padded = np.full((h * step, w * step), np.nan, dtype=np.float32)
+    padded[:block.shape[0], :block.shape[1]] = block
+    blocks = padded.reshape(h, step, w, step)
+    with np.errstate(invalid='ignore'):
+        counts = (~np.isnan(blocks)).sum(axis=(1, 3))
+        sums = np.nansum(blocks, axis=(1, 3))
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan).astype(np.float32)
+
+
+def colorize(values):
+    '''
+    (h, w, 3) uint8 RGB for correlations in [-1, 1].
+    '''
+    v = np.clip(np.nan_to_num(values, nan=0.0), -1, 1)[..., None]
+    rgb = np.where(v < 0, NEUTRAL + (NEUTRAL - NEGATIVE) * v, NEUTRAL + (POSITIVE - NEUTRAL) * v)
+    rgb = np.rint(rgb).astype(np.uint8)
+    rgb[np.isnan(values)] = MISSING
+    return rgb
+
+
+def encode_png(rgb):
+    '''
+    A minimal 8-bit RGB PNG, without an imaging library.
+    '''
+    h, w, _ = rgb.shape
+    raw = np.zeros((h, w * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(h, w * 3)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def encode_tile(values, fmt):
+    '''
+    Returns (<bytes>, <mimetype>); 'bin' is row-major little-endian float32.
+    '''
+    if fmt == 'png':
+        return encode_png(colorize(values)), 'image/png'
+    return values.astype('<f4').tobytes(), 'application/octet-stream'
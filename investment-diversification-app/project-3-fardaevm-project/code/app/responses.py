@@ -0,0 +1,52 @@
+'''
+Rendered API responses, cached in memory per data version and served with
+strong ETags, so clients can revalidate with If-None-Match.
+'''
+import hashlib
+import os
+
+from flask import (
+    jsonify,
+    make_response,
+    request,
+)
+
+from graph.cache import LRUCache
+from service import ServiceError
+
+
+# Rendered API responses by (endpoint, ticker, algo, n, ..., data version);
+# a new data version makes every older entry unreachable at once.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 4096))
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', 64 * 2 ** 20))
+RESPONSES = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_BYTES, sizeof=lambda r: len(r[1]))
+
+
+def cached_response(service, key, build, vary=None, cache=None):
+    '''
+    Serve build()'s response from `cache` (RESPONSES by default) for
+    `service`'s data version, with a strong ETag; answers If-None-Match with
+    a 304. A ServiceError from build() is a 400, and is not cached.
+
+    vary: the request header `key` depends on, eg. 'Accept', so shared
+        caches keep the variants apart.
+    '''
+    cache = RESPONSES if cache is None else cache
+    key = key + (service.data_version(),)
+    hit = cache.get(key)
+    if hit is None:
+        try:
+            response = build()
+        except ServiceError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+        body = response.get_data()
+        hit = (hashlib.sha1(body).hexdigest(), body, response.mimetype)
+        cache.put(key, hit)
+
+    etag, body, mimetype = hit
+    response = make_response(body, 200)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    if vary is not None:
+        response.vary.add(vary)
+    return response.make_conditional(request)
@@ -0,0 +1,395 @@
+'''
+Similarity queries behind the ticker page and the JSON API.
+
+Both render from the same typed results, so the page no longer builds a
+JSON response just to parse it back, and the dates are formatted once per
+dataset version instead of on every request.
+'''
+import json
+import logging
+import os
+from threading import Lock
+from time import monotonic
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # optional, see encode_columnar
+    orjson = None
+
+from features import (
+    KERNELS,
+    PEARSON,
+    StocksFeatures,
+)
+
+
+## Algorithms
+PAGE_RANK = 'page_rank'
+LOUVAIN = 'louvain'
+LEIDEN = 'leiden'
+
+ALGO_2_PROPERTY = {
+    PAGE_RANK: 'pageRank',
+    LOUVAIN: 'community',
+    LEIDEN: 'leiden_community',
+}
+
+# Date labels on the charts, eg. 01/02/25
+LABEL_FORMAT = '%m/%d/%y'
+
+# Seconds to wait before asking an unavailable graph (Neo4j) again, like
+# graph.VERSION_TTL_SECONDS.
+GRAPH_RETRY_SECONDS = float(os.environ.get('N4J_VERSION_TTL', 30))
+
+# Opt-in compact response, see columnar()
+COLUMNAR = 'columnar'
+COLUMNAR_MIMETYPE = 'application/vnd.quantari.columnar+json'
+
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceError(ValueError):
+    '''
+    A bad request, eg. an unknown ticker; rendered as a 400.
+    '''
+
+
+class Series(object):
+    '''
+    Closes for several tickers, columnar: one (dates, closes) array pair per
+    ticker, in the order of `tickers`.
+    '''
+
+    def __init__(self, tickers, dates, closes):
+        self.tickers = tickers
+        self.dates = dates
+        self.closes = closes
+
+    @classmethod
+    def from_ts(cls, ts):
+        '''
+        ts: {<ticker>: (<dates>, <closes>)}, see StocksFeatures.ts_for_tickers
+        '''
+        tickers = list(ts)
+        return cls(tickers, [ts[t][0] for t in tickers], [ts[t][1] for t in tickers])
+
+    def ts(self):
+        return dict(zip(self.tickers, zip(self.dates, self.closes)))
+
+    def records(self):
+        '''
+        The API's {<ticker>: [[<datetime>, <close>], ...]}
+        '''
+        return StocksFeatures.ts_records(self.ts())
+
+    def aligned(self, axis):
+        '''
+        {<ticker>: <closes on `axis`, NaN where the ticker has no close>}
+        '''
+        out = {}
+        for t, dates, closes in zip(self.tickers, self.dates, self.closes):
+            row = np.full(len(axis), np.nan)
+            row[np.searchsorted(axis, dates)] = closes
+            out[t] = row
+        return out
+
+
+class Similar(object):
+
+    def __init__(self, ticker, rank, series, group=None):
+        self.ticker = ticker
+        self.rank = rank
+        self.series = series
+        self.group = group
+
+    def to_json(self):
+        return {
+            'ticker': self.ticker,
+            'rank': self.rank,
+            'ts': self.series.records(),
+        }
+
+    def group_json(self, ts=None):
+        out = {
+            'group': self.group,
+            'rank': self.rank,
+            'ts': self.series.records() if ts is None else ts,
+        }
+        if self.ticker is not None:
+            out['ticker'] = self.ticker
+        return out
+
+
+def columnar(results, grouped=False):
+    '''
+    The compact form of a similar (one result) or groups response: the
+    shared date axis once, as ISO UTC timestamps, and each ticker's closes
+    as an array on it, null where it has no close.
+
+        {'dates': [...], 'ticker': ..., 'rank': ..., 'ts': {<ticker>: [...]}}
+        {'dates': [...], 'groups': [{'group': ..., 'rank': ..., 'ts': ...}, ...]}
+    '''
+    dates = [d for r in results for d in r.series.dates]
+    axis = np.unique(np.concatenate(dates)) if dates else np.array([], dtype='datetime64[ns]')
+    out = {'dates': np.datetime_as_string(axis, unit='s', timezone='UTC').tolist()}
+    if grouped:
+        out['groups'] = [r.group_json(r.series.aligned(axis)) for r in results]
+    else:
+        result = results[0]
+        out.update({'ticker': result.ticker, 'rank': result.rank,
+                    'ts': result.series.aligned(axis)})
+    return out
+
+
+def prefers_columnar(args, accept):
+    '''
+    args: the query arguments, ?format=columnar asks for it.
+    accept: the Accept header, a werkzeug MIMEAccept.
+
+    Opt-in only: COLUMNAR_MIMETYPE has to be listed by name with a higher
+    quality than application/json. Wildcards such as */* never select it.
+    '''
+    if args.get('format') == COLUMNAR:
+        return True
+    quality = max((q for m, q in accept if m.lower() == COLUMNAR_MIMETYPE), default=0)
+    return quality > accept['application/json']
+
+
+def encode_columnar(payload):
+    '''
+    JSON bytes for a columnar() payload; orjson writes the numpy arrays
+    directly when it is installed.
+    '''
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def default(o):
+        if isinstance(o, np.ndarray):
+            return [None if np.isnan(v) else v for v in o.tolist()]
+        raise TypeError(f'cannot serialize {type(o)}')
+
+    return json.dumps(payload, default=default, separators=(',', ':')).encode()
+
+
+class DateLabels(object):
+    '''
+    Chart labels for every trading day of a dataset, formatted once.
+    '''
+
+    def __init__(self, days):
+        self.days = days
+        self.labels = np.array(pd.DatetimeIndex(days).strftime(LABEL_FORMAT), dtype=object)
+
+    def __call__(self, dates):
+        return self.labels[np.searchsorted(self.days, dates)]
+
+
+def process_algo_name(algo):
+    '''
+    Lower-case algorithm name, louvain when unknown.
+    '''
+    if algo is not None:
+        algo = algo.lower()
+    if algo not in ALGO_2_PROPERTY:
+        # TODO: maybe return an error instead
+        algo = LOUVAIN
+    return algo
+
+
+class SimilarityService(object):
+
+    def __init__(self, features, memberships, page_rank, graph_version=None, version=None):
+        '''
+        features: StocksFeatures
+        memberships: prop -> graph.membership.Memberships
+        page_rank: (ticker, n) -> [{'ticker': ..., 'score': ...}, ...]
+        graph_version: () -> the graph build's version, see graph.GraphVersion
+        version: the version of everything else the answers are built from,
+            eg. the PageRank table; see snapshot.stamp_version
+        '''
+        self.features = features
+        self.memberships = memberships
+        self.page_rank = page_rank
+        self.graph_version = graph_version
+        self.version = version
+        self._labels = None
+        self._matrices = {}
+        self._matrix_lock = Lock()
+        self._order = None
+        self._graph_failed = None
+
+    def data_version(self):
+        '''
+        Changes whenever the answers can: new prices or a new graph build.
+        '''
+        graph_version = None
+        if self.graph_version is not None:
+            # Without a graph, the answers that need it fail anyway.
+            graph_version = self.from_graph(self.graph_version)
+        return (self.features.digest, self.features.version, self.version, graph_version)
+
+    def from_graph(self, fn, *args):
+        '''
+        fn(*args), or None when the graph is unavailable. A failure is
+        remembered for GRAPH_RETRY_SECONDS, so requests do not each wait on
+        Neo4j while it is down.
+        '''
+        failed = self._graph_failed
+        if failed is not None and monotonic() - failed < GRAPH_RETRY_SECONDS:
+            return None
+        try:
+            out = fn(*args)
+        except Exception as e:
+            logger.warning('graph unavailable, retrying in %ss: %s', GRAPH_RETRY_SECONDS, e)
+            self._graph_failed = monotonic()
+            return None
+        self._graph_failed = None
+        return out
+
+    def tickers(self):
+        return self.features.names()
+
+    def check_ticker(self, ticker):
+        ticker = ticker.upper()
+        if ticker not in self.features.nameset():
+            raise ServiceError('unknown stock ticker')
+        return ticker
+
+    def check_step(self, step):
+        '''
+        The heatmap zoom, tickers per cell side, eg. from ?step=
+        '''
+        step = str(1 if step is None else step)
+        if not step.isdigit() or int(step) < 1:
+            raise ServiceError('step must be a positive integer')
+        return int(step)
+
+    def window(self, w):
+        '''
+        The correlation over the last `w` trading days, see StocksFeatures.windows
+        '''
+        windows = self.features.windows()
+        ix = windows.find(int(w)) if str(w).isdigit() else None
+        if ix is None:
+            raise ServiceError(f'unknown window, one of {windows.lengths()}')
+        return windows.view(ix)
+
+    def series(self, tickers):
+        return Series.from_ts(self.features.ts_for_tickers(tickers)['ts'])
+
+    def similar(self, ticker, algo=None, n=6, w=None):
+        '''
+        The `n` tickers most similar to `ticker` by `algo`, ranked by
+        correlation (over the last `w` days when given).
+        '''
+        ticker = self.check_ticker(ticker)
+        algo = process_algo_name(algo)
+        corr = self.window(w) if w is not None else None
+
+        if algo == PAGE_RANK:
+            _similar = self.page_rank(ticker, n)
+            filtered_similar = [_.get('ticker') for _ in _similar if _.get('score')][:n]
+            return Similar(ticker, [], self.series(filtered_similar + [ticker]))
+
+        # Otherwise use the community-based similarity based on a property.
+        prop = ALGO_2_PROPERTY[algo]
+        similar = self.memberships(prop).similar(ticker, prop)
+        # Rank similar stocks, and trim to top N
+        rank = self.features.rank_tickers(ticker, similar, n, corr=corr)
+        filtered_similar = [_[0] for _ in rank]
+        return Similar(ticker, rank, self.series(filtered_similar + [ticker]))
+
+    def groups(self, ticker, algo=None, n=6):
+        '''
+        The top `n` tickers of every community, `ticker`'s own first.
+        '''
+        ticker = self.check_ticker(ticker)
+        prop = ALGO_2_PROPERTY[process_algo_name(algo)]
+        collected = self.memberships(prop).grouped(ticker, prop)
+
+        out = []
+        for blob in collected:
+            rank = self.features.rank_tickers(ticker, blob['similar'], n)
+            filtered_similar = [_[0] for _ in rank]
+            if 'ticker' in blob:
+                out.append(Similar(ticker, rank, self.series(filtered_similar + [ticker]),
+                                   group=blob['group']))
+            else:
+                out.append(Similar(None, rank, self.series(filtered_similar),
+                                   group=blob['group']))
+        return out
+
+    def correlation(self, method=PEARSON):
+        '''
+        The correlation matrix by `method`, see features.kernels.KERNELS;
+        every measure is computed once per data version, however many tile
+        requests ask for it at the same time.
+        '''
+        method = (method or PEARSON).lower()
+        if method not in KERNELS:
+            raise ServiceError(f'unknown correlation, one of {list(KERNELS)}')
+        key = (method, self.features.version)
+        matrix = self._matrices.get(key)
+        if matrix is None:
+            with self._matrix_lock:
+                matrix = self._matrices.get(key)
+                if matrix is None:
+                    matrix = self.features.correlation(method)
+                    self._matrices = {k: m for k, m in self._matrices.items()
+                                      if k[1] == self.features.version}
+                    self._matrices[key] = matrix
+        return matrix
+
+    def heatmap_order(self, prop='community'):
+        '''
+        Tickers grouped by community for the heatmap.
+
+        Returns (<matrix index per position>, [[<group id>, <first>, <end>], ...]);
+        tickers without a community come last, in group None. Without the
+        graph, every ticker is in group None, by name.
+        '''
+        memberships = self.from_graph(self.memberships, prop)
+        key = (self.features.version, memberships.version if memberships is not None else None)
+        if self._order is None or self._order[0] != key:
+            group_of = dict(memberships.assignments(prop)) if memberships is not None else {}
+            names = self.features.names()
+            gids = sorted(set(group_of.values()) - {None})
+            rank = {gid: i for i, gid in enumerate(gids)}
+            order = sorted(range(len(names)), key=lambda ix: (
+                rank.get(group_of.get(names[ix]), len(rank)), names[ix]))
+            groups = []
+            for pos, ix in enumerate(order):
+                gid = group_of.get(names[ix])
+                if groups and groups[-1][0] == gid:
+                    groups[-1][2] = pos + 1
+                else:
+                    groups.append([gid, pos, pos + 1])
+            self._order = (key, (np.array(order, dtype=np.int64), groups))
+        return self._order[1]
+
+    def labels(self):
+        '''
+        DateLabels for the current data, rebuilt when its version changes.
+        '''
+        version = self.features.version
+        if self._labels is None or self._labels[0] != version:
+            self._labels = (version, DateLabels(self.features.trading_days()))
+        return self._labels[1]
+
+    def chart(self, series):
+        '''
+        ([<label>, ...] of the first ticker, [{<ticker>: [[<label>, <close>], ...]}, ...]),
+        tickers sorted by name.
+        '''
+        labels = self.labels()
+        data = []
+        for ix in sorted(range(len(series.tickers)), key=series.tickers.__getitem__):
+            dates, closes = series.dates[ix], series.closes[ix]
+            data.append({series.tickers[ix]: [list(p) for p in zip(labels(dates).tolist(),
+                                                                   closes.tolist())]})
+        first = list(data[0].values())[0] if data else []
+        return [label for label, _ in first], data
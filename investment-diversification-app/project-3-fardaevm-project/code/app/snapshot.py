@@ -0,0 +1,117 @@
+'''
+Immutable dataset snapshots, published by a background reloader.
+
+Requests read SnapshotReloader.current() once and use that snapshot to the
+end, without locking. A reload builds the next snapshot off to the side and
+publishes it with a single reference assignment; requests already in flight
+finish on the old one, which is dropped once nothing refers to it.
+'''
+import hashlib
+import os
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+
+
+# Seconds between checks for new data; 0 disables the background reloader.
+RELOAD_SECONDS = float(os.environ.get('RELOAD_SECONDS', 60))
+
+
+class Snapshot(object):
+    '''
+    One loaded dataset: the features (prices, indexes and matrices), the
+    local PageRank table and the service answering queries over them.
+    Never modified once published.
+    '''
+
+    def __init__(self, features, ppr_table, service, stamp=None):
+        self.features = features
+        self.ppr_table = ppr_table
+        self.service = service
+        self.stamp = stamp
+
+
+def source_stamp(*paths):
+    '''
+    Cheap change marker for files and directories: every file's path, size
+    and modification time.
+    '''
+    stamp = []
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            stamp.append((f, st.st_size, st.st_mtime_ns))
+    return tuple(stamp)
+
+
+def stamp_version(stamp):
+    '''
+    Short, cheaply hashed digest of a source_stamp, eg. for cache keys.
+    '''
+    return hashlib.sha1(repr(stamp).encode()).hexdigest()[:16]
+
+
+class SnapshotReloader(object):
+
+    def __init__(self, load, stamp, interval=RELOAD_SECONDS):
+        '''
+        load: stamp -> Snapshot, built from scratch.
+        stamp: () -> change marker of the data, eg. source_stamp(...)
+        interval: seconds between background checks, see self.start
+        '''
+        self._load = load
+        self._stamp = stamp
+        self.interval = interval
+        # Serializes reloads only; readers never take it.
+        self._reload_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        self._current = load(stamp())
+
+    def current(self):
+        return self._current
+
+    def reload(self, force=False):
+        '''
+        Build and publish a new snapshot when the data changed (or `force`).
+        Returns whether it did.
+        '''
+        with self._reload_lock:
+            stamp = self._stamp()
+            if not force and stamp == self._current.stamp:
+                return False
+            snapshot = self._load(stamp)
+            self._current = snapshot
+            return True
+
+    def start(self):
+        '''
+        Check for new data every self.interval seconds on a daemon thread; a
+        failed reload keeps the current snapshot and is retried next time.
+        '''
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = Thread(target=self._run, name='snapshot-reloader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if self.reload():
+                    print('reloaded dataset snapshot')
+            except Exception as e:
+                print(f'snapshot reload failed, keeping the current one: {e}')
@@ -0,0 +1,128 @@
+'''
+In-process Louvain and Leiden community detection on the weighted
+correlation graph, without Neo4j GDS. Produces the same node properties
+graph.build_graph writes (`community`, `leiden_community`).
+
+$ python3 communities.py ../data/pearson.csv ../data/communities.csv
+
+'''
+import random
+import sys
+
+import igraph
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Parity with graph.Session.build_louvain / build_leiden.
+LOUVAIN_MAX_LEVELS = 10
+LEIDEN_GAMMA = 1.075
+LEIDEN_MIN_COMMUNITY_SIZE = 5
+LEIDEN_THETA = 0.01
+SEED = 42
+
+# Output columns, named after the Neo4j node properties.
+TICKER = 'ticker'
+LOUVAIN = 'community'
+LEIDEN = 'leiden_community'
+
+
+def read_edges(path):
+    '''
+    path: edge export with a, b, weight columns, see StocksFeatures.export_graph
+
+    Return (<symmetric CSR weights>, <ticker names>)
+    '''
+    edges = pd.read_csv(path, usecols=['a', 'b', 'weight'])
+    names, codes = np.unique(np.concatenate([edges.a.to_numpy(), edges.b.to_numpy()]),
+                             return_inverse=True)
+    n = len(names)
+    a, b = codes[:len(edges)], codes[len(edges):]
+    lower = sparse.csr_matrix((edges.weight.to_numpy(dtype=np.float64), (a, b)), shape=(n, n))
+    return (lower + lower.T).tocsr(), names.tolist()
+
+
+def to_igraph(adjacency):
+    '''
+    adjacency: symmetric sparse weights, eg. StocksFeatures.sparse_graph()
+    '''
+    upper = sparse.triu(adjacency, k=1).tocoo()
+    g = igraph.Graph(n=adjacency.shape[0], edges=np.column_stack([upper.row, upper.col]).tolist())
+    g.es['weight'] = upper.data.tolist()
+    return g
+
+
+class seeded(object):
+    '''
+    Run igraph's randomized algorithms from a fixed seed.
+    '''
+    def __init__(self, seed=SEED):
+        self.seed = seed
+
+    def __enter__(self):
+        igraph.set_random_number_generator(random.Random(self.seed))
+
+    def __exit__(self, *exc):
+        igraph.set_random_number_generator(random)
+
+
+def louvain(adjacency, max_levels=LOUVAIN_MAX_LEVELS, gamma=1.0, seed=SEED):
+    '''
+    Weighted Louvain; returns the community id of every node.
+    '''
+    g = adjacency if isinstance(adjacency, igraph.Graph) else to_igraph(adjacency)
+    with seeded(seed):
+        levels = g.community_multilevel(weights='weight', return_levels=True,
+                                        resolution=gamma)
+    if not levels:
+        return np.arange(g.vcount())
+    return np.array(levels[min(max_levels, len(levels)) - 1].membership)
+
+
+def leiden(adjacency, gamma=LEIDEN_GAMMA, min_community_size=LEIDEN_MIN_COMMUNITY_SIZE,
+           theta=LEIDEN_THETA, seed=SEED):
+    '''
+    Weighted Leiden on modularity with resolution `gamma`. Like
+    gds.leiden.stream with minCommunitySize, nodes in communities smaller than
+    `min_community_size` get no community (-1).
+    '''
+    g = adjacency if isinstance(adjacency, igraph.Graph) else to_igraph(adjacency)
+    with seeded(seed):
+        clusters = g.community_leiden(objective_function='modularity', weights='weight',
+                                      resolution=gamma, beta=theta, n_iterations=-1)
+    membership = np.array(clusters.membership)
+    sizes = np.bincount(membership)
+    return np.where(sizes[membership] >= min_community_size, membership, -1)
+
+
+def detect(adjacency, names, seed=SEED):
+    '''
+    Return a frame of ticker, community (Louvain), leiden_community (Leiden,
+    missing for small communities).
+    '''
+    g = to_igraph(adjacency)
+    out = pd.DataFrame({
+        TICKER: names,
+        LOUVAIN: louvain(g, seed=seed),
+        LEIDEN: leiden(g, seed=seed),
+    })
+    out[LEIDEN] = out[LEIDEN].astype('Int64').where(out[LEIDEN] >= 0)
+    return out
+
+
+def groupings(communities, prop=LOUVAIN):
+    '''
+    [[<group id>, <ticker>], ...] like graph.Session.get_groups, for
+    StocksFeatures.collect_groups.
+    '''
+    ids = communities[prop].astype(object).where(communities[prop].notna(), None)
+    return [[gid, t] for gid, t in zip(ids.tolist(), communities[TICKER].tolist())]
+
+
+if __name__ == '__main__':
+    src, out = sys.argv[1], sys.argv[2]
+    adjacency, names = read_edges(src)
+    communities = detect(adjacency, names)
+    communities.to_csv(out, index=False)
+    print(f'{communities[LOUVAIN].nunique()} louvain, {communities[LEIDEN].nunique()} leiden '
+          f'communities for {len(names)} tickers; wrote {out}; done.')
@@ -1,14 +1,30 @@
 import csv
+import os
 
 from collections import defaultdict
 from copy import copy
+from itertools import repeat
 
 
 import numpy as np
 import pandas as pd
-from scipy.stats import spearmanr
-
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+
+from .artifacts import (
+    read_artifacts,
+    source_hash,
+    write_artifacts,
+)
+from .kernels import (
+    CorrelationKernel,
+    KERNELS,
+    PEARSON,
+)
+from .streaming import RollingCorrelation
+from .windows import (
+    WINDOWS,
+    window_correlations,
+)
 
 
 '''
@@ -21,6 +37,46 @@ sf.export_graph(dmat, 'pearson', '../data/pearson.csv')
 '''
 
 
+# Policies for tickers with missing trading days, see StocksFeatures.price_matrix
+MISSING_FFILL = 'ffill'  # carry the last close forward (and back-fill leading gaps)
+MISSING_DROP = 'drop'  # drop dates that are missing for any ticker
+MISSING_ALIGN = 'align'  # keep the gaps as NaN on the shared date axis
+MISSING_POLICIES = (MISSING_FFILL, MISSING_DROP, MISSING_ALIGN)
+
+# Columns the feature pipeline needs; everything else is company metadata.
+PRICE_COLUMNS = ['Date', 'Ticker', 'Close']
+
+# How many nearest neighbours to keep per ticker, see StocksFeatures.pearson
+NEIGHBOURS_K = 100
+NEIGHBOURS_BLOCK_ROWS = 1024
+
+
+def top_k(corr_rows, k, row_ids=None):
+    '''
+    corr_rows: (m, n) block of a correlation matrix.
+    k: number of neighbours to keep per row.
+    row_ids: column index of each row's own ticker, excluded from its neighbours.
+
+    Return (ids, scores), both (m, k), sorted by descending correlation.
+    '''
+    block = np.nan_to_num(corr_rows, nan=-np.inf, copy=True)
+    if row_ids is not None:
+        block[np.arange(block.shape[0]), row_ids] = -np.inf
+
+    # A row's own column is never one of its neighbours.
+    k = max(min(k, block.shape[1] - (row_ids is not None)), 0)
+    if k == 0:
+        empty = np.empty((block.shape[0], 0))
+        return empty.astype(np.int64), empty
+    if k < block.shape[1]:
+        ids = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    else:
+        ids = np.tile(np.arange(block.shape[1]), (block.shape[0], 1))
+    scores = np.take_along_axis(block, ids, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
 
 class StocksFeatures(object):
 
@@ -29,23 +85,161 @@ class StocksFeatures(object):
     Ticker = 'Ticker'
 
     @classmethod
-    def read_csv(cls, path='./sp500_metadata.csv'):
-        df = pd.read_csv(path)
-        df['Date'] = df.Date.map(pd.Timestamp)
-        return cls(df)
+    def read_prices(cls, path, **kwargs):
+        '''
+        Read a Parquet dataset (a directory or *.parquet file) when given one,
+        otherwise fall back to CSV. See read_parquet for the arguments.
+        '''
+        if os.path.isdir(path) or path.endswith('.parquet'):
+            return cls.read_parquet(path, **kwargs)
+        return cls.read_csv(path, **kwargs)
+
+    @classmethod
+    def read_parquet(cls, path, columns=PRICE_COLUMNS, start=None, end=None,
+                     tickers=None, **kwargs):
+        '''
+        path: Parquet dataset, see fetch_stock_prices.write_stocks
+        columns: columns to read, None for all of them.
+        start, end: only read dates in [start, end), eg. '2025-01-01'
+        tickers: only read these tickers.
+
+        The filters are pushed down to the reader, so partitions and row groups
+        outside of them are skipped.
+        '''
+        df = pd.read_parquet(path, columns=columns,
+                             filters=cls._filters(start, end, tickers) or None)
+        df[cls.Ticker] = df[cls.Ticker].astype(str)
+        df[cls.Date] = pd.to_datetime(df[cls.Date], utc=True)
+        return cls(df.reset_index(drop=True), **kwargs)
 
-    def __init__(self, df, periods=1):
+    @classmethod
+    def read_csv(cls, path='./sp500_metadata.csv', columns=None, start=None,
+                 end=None, tickers=None, **kwargs):
+        df = pd.read_csv(path, usecols=columns)
+        df['Date'] = pd.to_datetime(df.Date, utc=True)
+        for col, op, val in cls._filters(start, end, tickers):
+            if op == '>=':
+                df = df.loc[df[col] >= val]
+            elif op == '<':
+                df = df.loc[df[col] < val]
+            else:
+                df = df.loc[df[col].isin(val)]
+        return cls(df.reset_index(drop=True), **kwargs)
+
+    @classmethod
+    def _filters(cls, start=None, end=None, tickers=None):
+        filters = []
+        if start is not None:
+            filters.append((cls.Date, '>=', pd.Timestamp(start, tz='UTC')))
+        if end is not None:
+            filters.append((cls.Date, '<', pd.Timestamp(end, tz='UTC')))
+        if tickers is not None:
+            filters.append((cls.Ticker, 'in', list(tickers)))
+        return filters
+
+    @classmethod
+    def cached(cls, path, artifact_dir, start=None, end=None, **kwargs):
+        '''
+        path: source price history, eg. '../../data/current.csv', see read_prices
+        artifact_dir: where the .npy artifacts live, see features.artifacts
+        start, end: only use dates in [start, end)
+
+        Memory-map the artifacts when they were built from the current contents
+        of `path` with the same settings, otherwise read `path`, compute the
+        pearson matrix and rewrite the artifacts.
+        '''
+        digest = source_hash(path)
+        settings = cls._settings(**kwargs)
+        settings.update({'start': start and str(start), 'end': end and str(end)})
+
+        arrays = read_artifacts(artifact_dir, digest, settings)
+        if arrays is not None:
+            sf = cls.from_arrays(arrays, **kwargs)
+        else:
+            sf = cls.read_prices(path, columns=PRICE_COLUMNS, start=start, end=end, **kwargs)
+            write_artifacts(sf.arrays(), artifact_dir, digest, settings)
+        sf.digest = digest
+        return sf
+
+    @classmethod
+    def from_arrays(cls, arrays, **kwargs):
+        '''
+        Rebuild from the output of self.arrays(), without a DataFrame.
+        '''
+        sf = cls.__new__(cls)
+        sf.df = None
+        sf._configure(**kwargs)
+        sf._set_names(arrays['names'].tolist())
+        sf._ts_dates = arrays['ts_dates']
+        sf._ts_close = arrays['ts_close']
+        sf._ts_offsets = arrays['ts_offsets']
+        sf._dates = arrays['dates']
+        sf._price_mat = arrays['prices']
+        sf._pearson = arrays['pearson']
+        sf._nbr_ids = arrays['nbr_ids']
+        sf._nbr_scores = arrays['nbr_scores']
+        return sf
+
+    def __init__(self, df, periods=1, missing=MISSING_FFILL, neighbours=NEIGHBOURS_K):
         self.df = df
+        self._configure(periods, missing, neighbours)
+        self.preprocess()
+
+    @staticmethod
+    def _settings(periods=1, missing=MISSING_FFILL, neighbours=NEIGHBOURS_K):
+        return {'periods': periods, 'missing': missing, 'neighbours': neighbours}
+
+    def _configure(self, periods=1, missing=MISSING_FFILL, neighbours=NEIGHBOURS_K):
+        if missing not in MISSING_POLICIES:
+            raise ValueError(f'unknown missing day policy: {missing}')
         self._names = []
         self._ticker_idx = {}
         self._nameset = set()
         self.periods = periods
-        self.preprocess()
+        # Hash of the source data when loaded by self.cached, and a counter
+        # bumped whenever the data changes, see self.update_day
+        self.digest = None
+        self.version = 0
+        self.missing = missing
+        self.neighbours_k = neighbours
+
+        # Per-ticker time-series store, see self._index_ts
+        self._ts_dates = None
+        self._ts_close = None
+        self._ts_offsets = None
 
         # Cache matrices
+        self._dates = None
+        self._price_mat = None
         self._diff_mat = None
         self._pearson = None
         self._cosine = None
+        self._kernels = {}
+        self._windows = {}
+
+        # Nearest neighbours by pearson, see self._index_neighbours
+        self._nbr_ids = None
+        self._nbr_scores = None
+
+        # Incremental pearson, see self.update_day
+        self._rolling = None
+
+    def arrays(self):
+        '''
+        The arrays from_arrays needs, see features.artifacts.
+        '''
+        self.pearson()
+        return {
+            'names': np.array(self._names, dtype=str),
+            'ts_dates': self._ts_dates,
+            'ts_close': self._ts_close,
+            'ts_offsets': self._ts_offsets,
+            'dates': self._dates,
+            'prices': self._price_mat,
+            'pearson': self._pearson,
+            'nbr_ids': self._nbr_ids,
+            'nbr_scores': self._nbr_scores,
+        }
 
     def names(self):
         return copy(self._names)
@@ -59,69 +253,287 @@ class StocksFeatures(object):
         return self._names[ix]
 
     def preprocess(self):
-        self._names = list(sorted(self.df[self.Ticker].unique()))
+        self._set_names(list(sorted(self.df[self.Ticker].unique())))
+        self._index_ts()
+
+    def _set_names(self, names):
+        self._names = names
         for ix, name in enumerate(self._names):
             name = name.upper()
             self._ticker_idx[name] = ix
             self._nameset.add(name)
 
+    def _index_ts(self):
+        '''
+        Sort (date, close) by (ticker, date) once, so each ticker owns the
+        contiguous range self._ts_offsets[ix]:self._ts_offsets[ix + 1].
+        Dates are stored as naive UTC datetime64.
+        '''
+        codes = pd.Categorical(self.df[self.Ticker], categories=self._names).codes
+        dates = pd.to_datetime(self.df[self.Date], utc=True).dt.tz_localize(None).to_numpy()
+        order = np.lexsort((dates, codes))
+
+        self._ts_dates = dates[order]
+        self._ts_close = self.df[self.Close].to_numpy(dtype=np.float64)[order]
+        self._ts_offsets = np.searchsorted(codes[order], np.arange(len(self._names) + 1))
+
     def _ts_for_ticker(self, ticker):
-        df = self.df.loc[self.df['Ticker'] == ticker][['Date', 'Close']].copy()
-        out = []
-        for ix, row in df.iterrows():
-            out.append((row.Date, row.Close))
-        return out
+        '''
+        Return (dates, closes) arrays for a ticker; empty if it is unknown.
+        '''
+        ix = self._ticker_idx.get(ticker.upper())
+        if ix is None:
+            return self._ts_dates[:0], self._ts_close[:0]
+        lo, hi = self._ts_offsets[ix], self._ts_offsets[ix + 1]
+        return self._ts_dates[lo:hi], self._ts_close[lo:hi]
 
     def ts_for_tickers(self, tickers):
+        '''
+        Returns {'ts': {<ticker>: (<dates array>, <closes array>), ...}}
+        '''
         ts = {}
         for t in tickers:
             ts[t] = self._ts_for_ticker(t)
         return {'ts': ts}
 
-    def diff_matrix(self, row_name='Close', col_name='Ticker', ts_col='Date'):
+    def trading_days(self):
         '''
-        Make a relative difference vector from each time series.
+        Every distinct date in the time-series store, sorted.
         '''
-        if self._diff_mat is None:
-            names = sorted(self.df[col_name].unique())
-            m = []
-            for name in names:
-                nf = self.df.loc[self.df[col_name] == name].copy()
+        return np.unique(self._ts_dates)
+
+    @staticmethod
+    def ts_records(ts):
+        '''
+        ts: {<ticker>: (<dates array>, <closes array>)}, see ts_for_tickers
+
+        Returns the JSON-friendly {<ticker>: [[<datetime>, <close>], ...]}
+        '''
+        out = {}
+        for t, (dates, closes) in ts.items():
+            out[t] = [list(pair) for pair in zip(dates.astype('datetime64[us]').tolist(),
+                                                 closes.tolist())]
+        return out
+
+    def price_matrix(self):
+        '''
+        Pivot the per-ticker time-series store once into a dense
+        (<num dates>, <num tickers>) array, columns ordered like self.names().
+
+        Gaps are handled according to self.missing, see MISSING_POLICIES.
+        '''
+        if self._price_mat is None:
+            dates, rows = np.unique(self._ts_dates, return_inverse=True)
+            cols = np.repeat(np.arange(len(self._names)), np.diff(self._ts_offsets))
+            prices = np.full((len(dates), len(self._names)), np.nan)
+            prices[rows, cols] = self._ts_close
+
+            if self.missing == MISSING_FFILL:
+                prices = pd.DataFrame(prices).ffill().bfill().to_numpy()
+            elif self.missing == MISSING_DROP:
+                keep = ~np.isnan(prices).any(axis=1)
+                dates, prices = dates[keep], prices[keep]
+
+            self._dates = dates
+            self._price_mat = prices
 
-                if not nf[ts_col].is_monotonic_increasing:
-                    raise Exception('need to sort ts column')
+        return self._price_mat
 
-                m.append(nf[row_name].diff(periods=self.periods)[1:])
-            # (<num tickers>, <num ts observations>)
-            self._diff_mat = np.array(m)
+    def dates(self):
+        '''
+        The shared date axis of self.price_matrix().
+        '''
+        self.price_matrix()
+        return self._dates
+
+    def diff_matrix(self):
+        '''
+        Make a difference vector from each time series.
+
+        Returns shape (<num tickers>, <num ts observations> - periods)
+        '''
+        if self._diff_mat is None:
+            prices = self.price_matrix()
+            p = self.periods
+            self._diff_mat = np.ascontiguousarray((prices[p:] - prices[:-p]).T)
 
         return self._diff_mat
 
+    def returns_matrix(self, log=False):
+        '''
+        Period returns for each time series, shaped like self.diff_matrix().
+
+        log: use log returns instead of simple returns.
+        '''
+        prices = self.price_matrix()
+        p = self.periods
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if log:
+                ret = np.log(prices[p:] / prices[:-p])
+            else:
+                ret = prices[p:] / prices[:-p] - 1.0
+        return np.ascontiguousarray(ret.T)
+
+    def update_day(self, date, closes, roll=True):
+        '''
+        date: the new trading day, eg. '2025-03-10'
+        closes: {<ticker>: <close>}; tickers left out count as missing that day.
+        roll: drop the oldest day, keeping the window length.
+
+        Append one day to the price matrix and the time series, and keep
+        self.pearson() current with rank-1 updates, see features.streaming.
+        '''
+        prices = self.price_matrix()
+        date = pd.to_datetime(date, utc=True).tz_localize(None).to_datetime64()
+        if len(self._dates) and date <= self._dates[-1]:
+            raise ValueError(f'{date} is not after the last day {self._dates[-1]}')
+
+        row = np.full(len(self._names), np.nan)
+        for t, close in closes.items():
+            ix = self._ticker_idx.get(t.upper())
+            if ix is not None:
+                row[ix] = close
+        present = ~np.isnan(row)
+        self._append_ts(date, row, present)
+        self.version += 1
+
+        if self.missing == MISSING_FFILL:
+            row[~present] = prices[-1, ~present]
+        elif self.missing == MISSING_DROP and not present.all():
+            # The day is missing for some ticker, so the matrix skips it.
+            return
+
+        if self._rolling is None:
+            self._rolling = RollingCorrelation(self.diff_matrix())
+        p = self.periods
+        self._rolling.add(row - prices[-p], drop=roll)
+
+        start = 1 if roll else 0
+        self._dates = np.append(self._dates[start:], date)
+        self._price_mat = np.vstack([prices[start:], row[None, :]])
+        if roll:
+            self._drop_ts_before(self._dates[0])
+        self._diff_mat = None
+        self._cosine = None
+        self._kernels = {}
+        self._windows = {}
+        self._pearson = self._rolling.corr()
+        self._index_neighbours(self._pearson)
+
+    def update(self, df, roll=True):
+        '''
+        df: new price rows with Date, Ticker and Close columns, eg. from
+        fetch_stock_prices.refresh_stocks; applied one day at a time.
+        '''
+        dates = pd.to_datetime(df[self.Date], utc=True)
+        for date, day in df.groupby(dates, sort=True):
+            self.update_day(date, dict(zip(day[self.Ticker], day[self.Close])), roll=roll)
+
+    def _append_ts(self, date, row, present):
+        '''
+        Insert the day's closes at the end of each present ticker's range.
+        '''
+        ixs = np.flatnonzero(present)
+        at = self._ts_offsets[ixs + 1]
+        self._ts_dates = np.insert(self._ts_dates, at, date)
+        self._ts_close = np.insert(self._ts_close, at, row[ixs])
+        self._ts_offsets = self._ts_offsets + np.searchsorted(ixs, np.arange(len(self._ts_offsets)), side='left')
+
+    def _drop_ts_before(self, date):
+        keep = self._ts_dates >= date
+        self._ts_dates = self._ts_dates[keep]
+        self._ts_close = self._ts_close[keep]
+        self._ts_offsets = np.concatenate([[0], np.cumsum(keep)])[self._ts_offsets]
+
+    def kernel(self, dtype=np.float64):
+        '''
+        The correlation kernel over self.diff_matrix(), see features.kernels;
+        one per dtype, so its buffers are shared by every measure.
+        '''
+        key = np.dtype(dtype).name
+        if key not in self._kernels:
+            self._kernels[key] = CorrelationKernel(self.diff_matrix(), dtype=dtype)
+        return self._kernels[key]
+
+    def correlation(self, method=PEARSON, dtype=np.float64):
+        '''
+        method: one of features.kernels.KERNELS, eg. 'spearman'
+
+        Pearson in float64 is self.pearson(), the others are computed on demand.
+        '''
+        if method == PEARSON and np.dtype(dtype) == np.float64:
+            return self.pearson()
+        return self.kernel(dtype).corr(method)
+
+    def windows(self, windows=WINDOWS, stride=None):
+        '''
+        windows: window lengths, in observations of self.diff_matrix()
+        stride: also compute the earlier windows ending every `stride`
+        observations, for rolling correlations.
+
+        Pearson for every window in one pass, see features.windows; each
+        window is labelled with the dates of its first and last observation.
+        '''
+        key = (tuple(windows), stride)
+        if key not in self._windows:
+            cw = window_correlations(self.diff_matrix(), windows, stride)
+            cw.ends = self.dates()[self.periods:]
+            self._windows[key] = cw
+        return self._windows[key]
+
     def pearson_features(self):
-        mat = self.diff_matrix()
-        return np.corrcoef(mat)
+        return self.kernel().pearson()
 
     def spearman_features(self):
-        mat = self.diff_matrix()
-        return spearmanr(man, axis=1)
+        return self.kernel().spearman()
 
     def pearson(self):
         if self._pearson is None:
             self._pearson = self.pearson_features()
+            self._index_neighbours(self._pearson)
         return self._pearson
 
+    def _index_neighbours(self, corr):
+        '''
+        Keep the top self.neighbours_k neighbour ids and scores for every ticker,
+        computed in row blocks so the full matrix is never copied.
+        '''
+        n = corr.shape[0]
+        k = max(min(self.neighbours_k, n - 1), 0)
+        ids = np.empty((n, k), dtype=np.int64)
+        scores = np.empty((n, k), dtype=np.float64)
+        for lo in range(0, n, NEIGHBOURS_BLOCK_ROWS):
+            hi = min(lo + NEIGHBOURS_BLOCK_ROWS, n)
+            ids[lo:hi], scores[lo:hi] = top_k(corr[lo:hi], k, row_ids=np.arange(lo, hi))
+        self._nbr_ids = ids
+        self._nbr_scores = scores
+
+    def neighbours(self, name):
+        '''
+        name: stock ticker, eg. 'AAPL'
+
+        Return (ids, scores) of its nearest tickers by pearson, best first.
+        '''
+        self.pearson()
+        ix = self.ix(name)
+        return self._nbr_ids[ix], self._nbr_scores[ix]
+
     def cosine_features(self):
         if self._cosine is None:
-            mat = self.diff_matrix()
-            self._cosine = cosine_similarity(mat)
+            self._cosine = self.kernel().cosine()
         return self._cosine
 
-    def export_attrs(self, path):
+    def export_attrs(self, path, metadata=None):
         '''
         Export the company attributes.
+
+        metadata: frame with the company columns, eg. read from
+        fetch_stock_prices.METADATA_PATH; defaults to self.df.
         '''
         header = ['ticker', 'name', 'sector', 'industry']
-        unique = self.df[['Ticker', 'Short Name', 'Sector', 'Industry']].drop_duplicates()
+        if metadata is None:
+            metadata = self.df
+        unique = metadata[['Ticker', 'Short Name', 'Sector', 'Industry']].drop_duplicates()
         with open(path, 'w') as f:
             writer = csv.writer(f)
             writer.writerow(header)
@@ -131,27 +543,103 @@ class StocksFeatures(object):
 
 
     def export_graph(self, corr_mat, relationship, path, drop_threshold=0,
-                     replace_drop=None):
+                     replace_drop=None, chunk_rows=None):
         '''
         Given a correlation matrix, export an undirected graph to CSV.
 
+        Correlations <= drop_threshold are replaced with replace_drop, or
+        skipped when replace_drop is None.
+
+        chunk_rows: stream the lower triangle this many matrix rows at a time,
+        for matrices too large to triangulate in memory (eg. memory-mapped);
+        None builds every edge in one shot.
+        '''
+        n = corr_mat.shape[0]
+        step = n if chunk_rows is None else max(int(chunk_rows), 1)
+        parts = (self._lower_edges(corr_mat, lo, min(lo + step, n), drop_threshold, replace_drop)
+                 for lo in range(0, n, step))
+        self._write_edges(parts, relationship, path)
+
+    def export_tiled_graph(self, relationship, path, drop_threshold=0, replace_drop=None,
+                           **kwargs):
+        '''
+        Like export_graph(self.pearson(), ...), without the dense matrix: the
+        edges above drop_threshold (every edge when None) are kept tile by
+        tile, in float32. Edges of constant series (NaN correlation) are
+        never kept.
+
+        replace_drop is not supported: the dropped edges are never built.
+        See features.tiled for the keyword arguments.
         '''
+        if replace_drop is not None:
+            raise ValueError('replace_drop needs every edge, use export_graph')
+        threshold = -np.inf if drop_threshold is None else drop_threshold
+        a, b, corr = self.tiled(threshold=threshold, **kwargs)['edges']
+        self._write_edges([(a, b, (corr.astype(np.float64) * 1000).tolist())],
+                          relationship, path)
+
+    def _write_edges(self, parts, relationship, path):
         header = ['a', 'b', 'relationship', 'weight']
+        names = np.array(self._names, dtype=object)
         with open(path, 'w') as f:
             writer = csv.writer(f)
             writer.writerow(header)
-            for a, b in zip(*np.tril_indices(corr_mat.shape[0], k=-1)):
-                val = corr_mat[(a, b)]
+            for a, b, weight in parts:
+                writer.writerows(zip(names[a], names[b], repeat(relationship, len(a)), weight))
 
-                skip_or_swap = drop_threshold is not None and val <= drop_threshold
-                if skip_or_swap:
-                    # Swap
-                    val = replace_drop
+    def tiled(self, k=None, threshold=None, out=None, **kwargs):
+        '''
+        Pearson over self.diff_matrix() computed tile by tile, keeping only
+        the top-k neighbours, the edges above threshold and/or a memory-mapped
+        matrix at `out`; see features.tiled.tiled_correlation.
+        '''
+        from .tiled import tiled_correlation
+
+        return tiled_correlation(self.diff_matrix(), k=k, threshold=threshold, out=out, **kwargs)
+
+    def sparse_graph(self, corr_mat=None, drop_threshold=0, chunk_rows=None):
+        '''
+        The graph export_graph writes, as a symmetric scipy CSR matrix of
+        weights (correlation * 1000), without going through CSV.
 
-                if val is None:
-                    # Skip
-                    continue
-                writer.writerow([self.name(a), self.name(b), relationship, val*1000])
+        corr_mat: defaults to self.pearson()
+        '''
+        if corr_mat is None:
+            corr_mat = self.pearson()
+        n = corr_mat.shape[0]
+        step = n if chunk_rows is None else max(int(chunk_rows), 1)
+
+        parts = [self._lower_edges(corr_mat, lo, min(lo + step, n), drop_threshold)
+                 for lo in range(0, n, step)]
+        a = np.concatenate([p[0] for p in parts])
+        b = np.concatenate([p[1] for p in parts])
+        w = np.concatenate([np.asarray(p[2], dtype=np.float64) for p in parts])
+        lower = sparse.csr_matrix((w, (a, b)), shape=(n, n))
+        return (lower + lower.T).tocsr()
+
+    @staticmethod
+    def _lower_edges(corr_mat, lo, hi, drop_threshold=0, replace_drop=None):
+        '''
+        Edges (a, b, <list of weights>) for rows lo:hi of the strict lower
+        triangle, in np.tril_indices order. Weights are correlations * 1000.
+        '''
+        rows = np.arange(lo, hi)
+        block = np.asarray(corr_mat[lo:hi, :hi])
+        a, b = np.nonzero(np.arange(hi)[None, :] < rows[:, None])
+        val = block[a, b]
+        a += lo
+
+        if drop_threshold is None:
+            return a, b, (val * 1000).tolist()
+
+        drop = val <= drop_threshold
+        if replace_drop is None:
+            keep = ~drop
+            return a[keep], b[keep], (val[keep] * 1000).tolist()
+
+        weight = (val * 1000).astype(object)
+        weight[drop] = replace_drop * 1000
+        return a, b, weight.tolist()
 
     def nearest_corr(self, corr_matrix, name, n=100):
         """
@@ -162,33 +650,46 @@ class StocksFeatures(object):
         Return list of (<ticker name>, <similarity ranking to target>)
         """
         ix = self.ix(name.upper())
-        s = pd.Series(corr_matrix[ix])
-        s_sorted = s.nlargest(n+1)[1:]
-        out = []
-        for ix, rank in s_sorted.items():
-            n = self.name(ix)
-            out.append((n, rank))
-        return out
-
-    def rank_tickers(self, target, others, n):
+        if corr_matrix is self._pearson and n <= self._nbr_ids.shape[1]:
+            ids, scores = self._nbr_ids[ix, :n], self._nbr_scores[ix, :n]
+        else:
+            ids, scores = top_k(corr_matrix[ix:ix + 1], n, row_ids=[ix])
+            ids, scores = ids[0], scores[0]
+        return [(self.name(i), s) for i, s in zip(ids.tolist(), scores.tolist())]
+
+    def rank_tickers(self, target, others, n, corr=None):
         '''
         tickers: list of stock tickers
         others: list of stock tikers
         n: select the most `n` most correlated tickers.
+        corr: rank by this matrix, eg. a window from self.windows(), instead
+        of self.pearson().
 
-        Return list of sorted tickers and their scores.
+        Return list of sorted tickers and their scores; `target` itself and
+        tickers without price data are left out.
         '''
+        p_corr = self.pearson() if corr is None else corr
         target_ix = self.ix(target)
-        p_corr = self.pearson_features()
-        target_corr = p_corr[target_ix]
 
-        namea = np.array(self.names())
-        nmask = np.isin(namea, others)
-        ranks = target_corr[nmask]
-        out = []
-        for ticker, rank in zip(others, ranks):
-            out.append((ticker, rank))
-        return sorted(out, reverse=True, key=lambda x: x[1])[:n]
+        others_ix = [self._ticker_idx.get(o.upper()) for o in others]
+        others_ix = np.unique(np.array(
+            [i for i in others_ix if i is not None and i != target_ix], dtype=np.int64))
+        n = min(n, len(others_ix))
+        if n <= 0:
+            return []
+
+        # Answer from the neighbour table when enough of `others` are in it.
+        hit = None
+        if corr is None:
+            ids, scores = self._nbr_ids[target_ix], self._nbr_scores[target_ix]
+            hit = np.isin(ids, others_ix)
+        if hit is not None and hit.sum() >= n:
+            ids, scores = ids[hit][:n], scores[hit][:n]
+        else:
+            ids, scores = top_k(p_corr[target_ix:target_ix + 1, others_ix], n)
+            ids, scores = others_ix[ids[0]], scores[0]
+
+        return [(self.name(i), s) for i, s in zip(ids.tolist(), scores.tolist())]
 
     def ts_ranked(self, ticker, grouped, n):
         '''
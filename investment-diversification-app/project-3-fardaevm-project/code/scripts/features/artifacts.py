@@ -0,0 +1,154 @@
+'''
+Persist the StocksFeatures arrays (aligned prices, ticker index, pearson
+matrix and neighbour table) as .npy files, next to a manifest holding a hash
+of the source data they were built from.
+
+Each build goes into a directory of its own, named after its manifest, and
+the CURRENT file names the one to read. Processes rebuilding at the same
+time (eg. gunicorn workers starting after the data changed) never write to
+each other's files, and readers never see arrays under a stale manifest.
+
+The app memory-maps them at startup instead of re-parsing the CSV and
+recomputing the correlations:
+
+$ PYTHONPATH=../scripts python3 -m features.artifacts ../../data/current.csv ../../data/artifacts
+
+'''
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+# Names the build directory in use, see write_artifacts
+CURRENT = 'CURRENT'
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def source_hash(path):
+    '''
+    sha256 of a file, or of every file below a directory (names included).
+    '''
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = []
+        for root, _, files in os.walk(path):
+            paths.extend(os.path.join(root, f) for f in files)
+    else:
+        paths = [path]
+
+    for p in sorted(paths):
+        h.update(os.path.relpath(p, path).encode())
+        with open(p, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def write_artifacts(arrays, out_dir, digest, settings):
+    '''
+    arrays: {<name>: <numpy array>}, see StocksFeatures.arrays
+    digest: source_hash of the data the arrays were built from.
+    settings: JSON-able settings the arrays were built with; rebuilt on mismatch.
+
+    The set is written to a private temporary directory, which is renamed to
+    its build name and then published by replacing CURRENT. Another process
+    publishing the same build first is not an error: the content is the
+    same. Older builds are removed; arrays already memory-mapped from them
+    stay readable.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {
+        'source_hash': digest,
+        'settings': settings,
+        'arrays': sorted(arrays),
+    }
+    build = build_name(manifest)
+    path = os.path.join(out_dir, build)
+
+    if read_manifest(path) != manifest:
+        tmp = tempfile.mkdtemp(prefix='.build-', dir=out_dir)
+        try:
+            for name, arr in arrays.items():
+                with open(os.path.join(tmp, f'{name}.npy'), 'wb') as f:
+                    np.save(f, np.ascontiguousarray(arr), allow_pickle=False)
+            with open(os.path.join(tmp, MANIFEST), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Lost the race to a process publishing the same build.
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    fd, tmp = tempfile.mkstemp(prefix=f'.{CURRENT}-', dir=out_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(build)
+    os.replace(tmp, os.path.join(out_dir, CURRENT))
+
+    for name in os.listdir(out_dir):
+        old = os.path.join(out_dir, name)
+        if name != build and not name.startswith('.') and os.path.isdir(old):
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def build_name(manifest):
+    '''
+    Directory name of a build: a hash of its manifest.
+    '''
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def current_build(out_dir):
+    '''
+    The build directory CURRENT points at, None when there is none.
+    '''
+    try:
+        with open(os.path.join(out_dir, CURRENT)) as f:
+            build = f.read().strip()
+    except OSError:
+        return None
+    return os.path.join(out_dir, build) if build else None
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_artifacts(out_dir, digest, settings, mmap_mode='r'):
+    '''
+    Return {<name>: <memory-mapped array>}, or None when the artifacts are
+    missing or were built from other data or settings.
+    '''
+    build = current_build(out_dir)
+    manifest = read_manifest(build) if build is not None else None
+    if manifest is None:
+        return None
+    if manifest.get('source_hash') != digest or manifest.get('settings') != settings:
+        return None
+
+    arrays = {}
+    for name in manifest['arrays']:
+        path = os.path.join(build, f'{name}.npy')
+        try:
+            arrays[name] = np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+    return arrays
+
+
+if __name__ == '__main__':
+    from . import StocksFeatures
+
+    src, out = sys.argv[1], sys.argv[2]
+    sf = StocksFeatures.cached(src, out)
+    print(f'{len(sf.names())} tickers; artifacts in {out}; done.')
@@ -0,0 +1,144 @@
+'''
+Correlation estimators over one (<num series>, <num observations>) matrix,
+eg. StocksFeatures.diff_matrix().
+
+    k = CorrelationKernel(sf.diff_matrix(), dtype=np.float32)
+    k.corr(SPEARMAN)
+
+Every estimator is a gram matrix of a row-normalized buffer: the centred
+observations (pearson, ledoit_wolf), the raw ones (cosine), their ranks
+(spearman) or their pairwise signs (kendall). The buffers are built once
+and reused, so another measure costs one more matrix multiply.
+'''
+import numpy as np
+from scipy.stats import rankdata
+from sklearn.covariance import ledoit_wolf_shrinkage
+
+
+PEARSON = 'pearson'
+SPEARMAN = 'spearman'
+KENDALL = 'kendall'
+LEDOIT_WOLF = 'ledoit_wolf'
+COSINE = 'cosine'
+KERNELS = (PEARSON, SPEARMAN, KENDALL, LEDOIT_WOLF, COSINE)
+
+# Memory for one chunk of the kendall sign buffer; the gram is summed over
+# chunks of the observation pairs, so the full buffer is never built.
+KENDALL_CHUNK_BYTES = 64 * 2 ** 20
+# Kendall costs O(n^2 T^2) over the sign buffer, so it only looks at this
+# many of the latest observations (about two years of trading days).
+KENDALL_MAX_OBSERVATIONS = 512
+
+
+def normalize_rows(obs, center=True, dtype=np.float64):
+    '''
+    Scale each row to unit length, after removing its mean when `center`.
+    Constant rows become NaN when centred (like np.corrcoef) and zero
+    otherwise (like sklearn's cosine_similarity).
+    '''
+    buf = np.array(obs, dtype=dtype)
+    if center:
+        buf -= buf.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(buf, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if center:
+            buf /= norms
+        else:
+            np.divide(buf, norms, out=buf, where=norms > 0)
+    return buf
+
+
+def gram(buf):
+    '''
+    buf @ buf.T, clipped to [-1, 1].
+    '''
+    out = buf @ buf.T
+    np.clip(out, -1, 1, out=out)
+    return out
+
+
+class CorrelationKernel(object):
+
+    def __init__(self, obs, dtype=np.float64):
+        '''
+        obs: (<num series>, <num observations>)
+        dtype: np.float32 halves the memory and doubles the BLAS throughput.
+        '''
+        self.obs = np.asarray(obs)
+        self.dtype = np.dtype(dtype)
+        self._standard = None
+        self._unit = None
+        self._ranks = None
+
+    def standardized(self):
+        '''
+        The shared centred, unit-length buffer.
+        '''
+        if self._standard is None:
+            self._standard = normalize_rows(self.obs, dtype=self.dtype)
+        return self._standard
+
+    def corr(self, method=PEARSON):
+        if method not in KERNELS:
+            raise ValueError(f'unknown correlation: {method}')
+        return getattr(self, method)()
+
+    def pearson(self):
+        return gram(self.standardized())
+
+    def cosine(self):
+        if self._unit is None:
+            self._unit = normalize_rows(self.obs, center=False, dtype=self.dtype)
+        return gram(self._unit)
+
+    def spearman(self):
+        '''
+        Pearson of the ranks, ties averaged, like scipy.stats.spearmanr.
+        '''
+        if self._ranks is None:
+            ranks = rankdata(self.obs, axis=1)
+            self._ranks = normalize_rows(ranks, dtype=self.dtype)
+        return gram(self._ranks)
+
+    def kendall(self):
+        '''
+        Kendall's tau-b: the cosine of the rows' pairwise sign vectors, whose
+        zeros are exactly the ties. The sign buffer has T (T - 1) / 2 columns,
+        so it is built and multiplied a chunk of KENDALL_CHUNK_BYTES at a time.
+
+        The cost grows with T^2, so only the last KENDALL_MAX_OBSERVATIONS
+        observations are used; a per-pair O(T log T) merge sort is faster
+        only for far longer series, and slower in numpy for n x n pairs.
+        '''
+        obs = self.obs[:, -KENDALL_MAX_OBSERVATIONS:]
+        n, t = obs.shape
+        cols = max(1, KENDALL_CHUNK_BYTES // max(1, n * self.dtype.itemsize))
+        dot = np.zeros((n, n))
+        counts = np.zeros(n)
+        chunk, size = [], 0
+        for a in range(t - 1):
+            chunk.append(np.sign(obs[:, a + 1:] - obs[:, a:a + 1]).astype(self.dtype))
+            size += t - 1 - a
+            if size >= cols or a == t - 2:
+                signs = np.concatenate(chunk, axis=1)
+                dot += signs @ signs.T
+                # The squared norm of a sign vector is its number of non-ties.
+                counts += np.count_nonzero(signs, axis=1)
+                chunk, size = [], 0
+        norms = np.sqrt(counts)
+        outer = np.outer(norms, norms)
+        out = np.divide(dot, outer, out=np.zeros_like(dot), where=outer > 0)
+        np.clip(out, -1, 1, out=out)
+        return out.astype(self.dtype, copy=False)
+
+    def ledoit_wolf(self):
+        '''
+        Pearson shrunk towards the identity by the Ledoit-Wolf intensity,
+        estimated on the standardized observations.
+        '''
+        z = self.standardized()
+        shrinkage = ledoit_wolf_shrinkage(np.nan_to_num(z.T) * np.sqrt(z.shape[1]),
+                                          assume_centered=True)
+        out = gram(z) * (1 - shrinkage)
+        out[np.diag_indices_from(out)] += shrinkage
+        return out
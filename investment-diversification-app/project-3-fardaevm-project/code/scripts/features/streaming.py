@@ -0,0 +1,91 @@
+'''
+Rolling pearson correlation kept current one observation at a time.
+
+    rc = RollingCorrelation(sf.diff_matrix())
+    rc.add(new_diffs, drop=True)
+    corr = rc.corr()
+
+The window's sums and cross-product matrix are updated with rank-1
+corrections, O(n^2) per observation instead of O(n^2 x T) for np.corrcoef,
+and recomputed exactly every RECOMPUTE_EVERY updates to bound the drift.
+'''
+from collections import deque
+
+import numpy as np
+
+
+# Exact recompute period, in updates.
+RECOMPUTE_EVERY = 64
+
+
+class RollingCorrelation(object):
+
+    def __init__(self, obs, recompute_every=RECOMPUTE_EVERY):
+        '''
+        obs: (<num series>, <num observations>) window, eg. a diff matrix.
+        '''
+        obs = np.asarray(obs, dtype=np.float64)
+        self.recompute_every = recompute_every
+        self._window = deque(np.array(obs.T))
+        self.updates = 0
+        self.recompute()
+
+    def __len__(self):
+        return len(self._window)
+
+    def recompute(self):
+        '''
+        Rebuild the sums from the window. Observations are shifted by the
+        window mean, which keeps the cross products small and well conditioned.
+        '''
+        obs = np.array(self._window).reshape(len(self._window), -1)
+        with np.errstate(invalid='ignore'):
+            self._shift = np.nan_to_num(obs.mean(axis=0)) if len(obs) else np.zeros(obs.shape[1])
+        centred = obs - self._shift
+        self._sum = centred.sum(axis=0)
+        self._cross = centred.T @ centred
+        self._since = 0
+
+    def add(self, x, drop=True):
+        '''
+        x: one observation per series.
+        drop: also drop the oldest observation, keeping the window length.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        self._window.append(x)
+        y = self._window.popleft() if drop else None
+        self.updates += 1
+        self._since += 1
+
+        # NaN sums never recover by subtraction, so dropping one recomputes.
+        if self._since >= self.recompute_every or (y is not None and not np.isfinite(y).all()):
+            self.recompute()
+            return
+
+        x = x - self._shift
+        self._sum += x
+        self._cross += np.outer(x, x)
+        if y is not None:
+            y = y - self._shift
+            self._sum -= y
+            self._cross -= np.outer(y, y)
+
+    def corr(self):
+        '''
+        The (n, n) pearson correlation of the window, like np.corrcoef.
+        '''
+        return corr_from_sums(self._sum, self._cross, len(self._window))
+
+
+def corr_from_sums(total, cross, m):
+    '''
+    Pearson correlation of m observations from their (shifted) sums and
+    cross-product matrix.
+    '''
+    mean = total / m
+    cov = cross / m - np.outer(mean, mean)
+    std = np.sqrt(np.clip(np.diag(cov), 0, None))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / std[:, None] / std[None, :]
+    np.clip(corr, -1, 1, out=corr)
+    return corr
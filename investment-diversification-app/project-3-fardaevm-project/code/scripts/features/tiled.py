@@ -0,0 +1,106 @@
+'''
+Pearson correlation for universes too large for a dense n x n matrix.
+
+    out = tiled_correlation(sf.diff_matrix(), k=100, threshold=0.5)
+    out['nbr_ids'], out['edges']
+
+The standardized float32 observations are multiplied one row panel at a
+time, on a process pool, and each panel is reduced to what the caller asked
+for before the next one is computed: the top-k neighbours per row, the
+lower-triangle edges above a threshold, and/or rows of a memory-mapped .npy
+matrix on disk. Panel heights are picked so the panels in flight fit in
+`budget` bytes.
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import top_k
+from .kernels import normalize_rows
+
+
+# Memory for the panels in flight, across workers.
+TILE_BUDGET_BYTES = 256 * 2 ** 20
+# A float32 panel cell plus the working copies top_k makes of it.
+PANEL_BYTES_PER_CELL = 24
+
+# Worker state, see _init_worker
+_WORKER = {}
+
+
+def panel_rows(n, workers, budget=TILE_BUDGET_BYTES):
+    '''
+    Rows per panel so `workers` (rows, n) panels fit in `budget`.
+    '''
+    return int(max(1, min(n, budget // max(1, workers * n * PANEL_BYTES_PER_CELL))))
+
+
+def _init_worker(z, out):
+    _WORKER['z'] = z
+    _WORKER['out'] = out
+
+
+def _panel(lo, hi, k, threshold):
+    z, out = _WORKER['z'], _WORKER['out']
+    block = z[lo:hi] @ z.T
+    np.clip(block, -1, 1, out=block)
+
+    ids = scores = edges = None
+    if k is not None:
+        ids, scores = top_k(block, k, row_ids=np.arange(lo, hi))
+    if threshold is not None:
+        # Strict lower triangle, in np.tril_indices order.
+        lower = block[:, :hi]
+        a, b = np.nonzero((np.arange(hi)[None, :] < np.arange(lo, hi)[:, None])
+                          & (lower > threshold))
+        edges = (a + lo, b, lower[a, b])
+    if out is not None:
+        mat = np.load(out, mmap_mode='r+')
+        mat[lo:hi] = block
+        mat.flush()
+        del mat
+    return lo, hi, ids, scores, edges
+
+
+def tiled_correlation(obs, k=None, threshold=None, out=None, workers=None,
+                      budget=TILE_BUDGET_BYTES):
+    '''
+    obs: (<num series>, <num observations>), eg. a diff matrix.
+    k: keep this many neighbours per row, see features.top_k
+    threshold: keep the lower-triangle edges with correlation > threshold.
+    out: write the full float32 matrix to this .npy path.
+    workers: processes; 1 runs in this process. Defaults to the CPU count.
+    budget: bytes for the panels in flight.
+
+    Returns {'nbr_ids', 'nbr_scores', 'edges': (a, b, corr), 'matrix'}, with
+    None for whatever was not asked for; 'matrix' is memory-mapped.
+    '''
+    z = normalize_rows(obs, dtype=np.float32)
+    n = z.shape[0]
+    workers = workers or os.cpu_count() or 1
+    k = max(min(k, n - 1), 0) if k else None
+    if out is not None:
+        np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=(n, n)).flush()
+
+    rows = panel_rows(n, workers, budget)
+    panels = [(lo, min(lo + rows, n)) for lo in range(0, n, rows)]
+
+    if workers == 1:
+        _init_worker(z, out)
+        results = [_panel(lo, hi, k, threshold) for lo, hi in panels]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(z, out)) as pool:
+            futures = [pool.submit(_panel, lo, hi, k, threshold) for lo, hi in panels]
+            results = [f.result() for f in futures]
+
+    result = {'nbr_ids': None, 'nbr_scores': None, 'edges': None, 'matrix': None}
+    if k is not None:
+        result['nbr_ids'] = np.concatenate([r[2] for r in results])
+        result['nbr_scores'] = np.concatenate([r[3] for r in results])
+    if threshold is not None:
+        result['edges'] = tuple(np.concatenate([r[4][i] for r in results]) for i in range(3))
+    if out is not None:
+        result['matrix'] = np.load(out, mmap_mode='r')
+    return result
@@ -0,0 +1,132 @@
+'''
+Correlations over several time windows in one pass.
+
+    cw = window_correlations(sf.diff_matrix(), windows=(30, 60, 90), stride=5)
+    cw.view(cw.find(30))
+
+Windows are counted in observations (trading days). The sums and cross
+products are accumulated once, in blocks between consecutive window
+boundaries, and snapshotted at every window start; each window is then the
+difference of two snapshots.
+'''
+import numpy as np
+
+from .streaming import corr_from_sums
+
+
+# Default window lengths, in observations.
+WINDOWS = (30, 60, 90)
+
+
+class CorrelationWindows(object):
+    '''
+    Pearson matrices for a set of windows, stacked in one float32 tensor.
+    '''
+
+    def __init__(self, tensor, spans, ends=None):
+        '''
+        tensor: (<num windows>, n, n)
+        spans: (<num windows>, 2) [start, end) observation indices.
+        ends: optional label per observation, eg. its date.
+        '''
+        self.tensor = tensor
+        self.spans = spans
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.spans)
+
+    def view(self, i):
+        '''
+        Window i's (n, n) matrix, a view into the tensor.
+        '''
+        return self.tensor[i]
+
+    def find(self, length, end=None):
+        '''
+        Index of the window of `length` observations ending at `end` (by
+        default the last one), or None when it was not computed.
+        '''
+        end = self.spans[:, 1].max() if end is None and len(self) else end
+        hit = np.flatnonzero((self.spans[:, 1] - self.spans[:, 0] == length)
+                             & (self.spans[:, 1] == end))
+        return int(hit[0]) if len(hit) else None
+
+    def lengths(self):
+        return sorted(set((self.spans[:, 1] - self.spans[:, 0]).tolist()))
+
+    def label(self, i):
+        '''
+        (<first observation>, <last observation>) of window i, using `ends`.
+        '''
+        start, end = self.spans[i]
+        if self.ends is None:
+            return start, end - 1
+        return self.ends[start], self.ends[end - 1]
+
+
+def window_spans(num_obs, windows=WINDOWS, stride=None):
+    '''
+    [start, end) of the trailing window of each length and, with a stride,
+    the earlier windows ending every `stride` observations before it.
+    Lengths longer than the data are skipped.
+    '''
+    spans = []
+    for length in windows:
+        if length < 2 or length > num_obs:
+            continue
+        ends = [num_obs] if not stride else range(num_obs, length - 1, -stride)
+        spans.extend((end - length, end) for end in ends)
+    return np.array(spans, dtype=np.int64).reshape(-1, 2)
+
+
+def window_correlations(obs, windows=WINDOWS, stride=None, dtype=np.float32):
+    '''
+    obs: (<num series>, <num observations>), eg. a diff matrix.
+
+    Returns CorrelationWindows over window_spans(...). Series with a NaN in
+    a window are NaN in that window's matrix, like np.corrcoef.
+    '''
+    obs = np.asarray(obs, dtype=np.float64)
+    n, t = obs.shape
+    spans = window_spans(t, windows, stride)
+    tensor = np.empty((len(spans), n, n), dtype=dtype)
+
+    # Shift by the mean so the cross products stay small.
+    nans = np.isnan(obs)
+    with np.errstate(invalid='ignore'):
+        shift = np.nan_to_num(np.nanmean(obs, axis=1)) if t else np.zeros(n)
+    shifted = np.where(nans, 0, obs - shift[:, None])
+
+    pending = {}
+    for start in spans[:, 0].tolist():
+        pending[start] = pending.get(start, 0) + 1
+    ends = {}
+    for i, end in enumerate(spans[:, 1].tolist()):
+        ends.setdefault(end, []).append(i)
+
+    total, cross, missing = np.zeros(n), np.zeros((n, n)), np.zeros(n, dtype=np.int64)
+    snapshots = {}
+    cursor = 0
+    for b in sorted(set(pending) | set(ends)):
+        block = shifted[:, cursor:b]
+        total += block.sum(axis=1)
+        cross += block @ block.T
+        missing += nans[:, cursor:b].sum(axis=1)
+        cursor = b
+
+        for i in ends.get(b, []):
+            start = int(spans[i, 0])
+            s_total, s_cross, s_missing = snapshots[start]
+            corr = corr_from_sums(total - s_total, cross - s_cross, b - start)
+            gaps = missing - s_missing > 0
+            corr[gaps, :] = np.nan
+            corr[:, gaps] = np.nan
+            tensor[i] = corr
+            pending[start] -= 1
+            if not pending[start]:
+                del snapshots[start]
+        if pending.get(b):
+            snapshots[b] = (total.copy(), cross.copy(), missing.copy())
+
+    return CorrelationWindows(tensor, spans)
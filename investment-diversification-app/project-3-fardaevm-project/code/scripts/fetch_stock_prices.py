@@ -1,15 +1,231 @@
-import yfinance as yf
 import pandas as pd
+import numpy as np
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
 from datetime import (
     datetime,
     timedelta,
     UTC
 )
+from threading import Lock
+import os
+import random
+import shutil
+import sys
 import time
+import zlib
 
 STOCKS_DAYS_BACK = 90
 YAHOO_SLEEPINESS_SECONDS = 1.2
 
+# Fetch engine: a bounded worker pool sharing one rate limit. Refresh time
+# scales with the request rate, not with round-trip latency x ticker count.
+FETCH_WORKERS = 4
+REQUESTS_PER_SECOND = 1 / YAHOO_SLEEPINESS_SECONDS
+REQUEST_BURST = 2
+# Tickers per multi-ticker history download.
+HISTORY_BATCH_SIZE = 50
+RETRIES = 3
+BACKOFF_SECONDS = 2.0
+
+# Parquet price store partitioned by ticker, and the company metadata that
+# used to be repeated on every CSV row.
+PRICES_PATH = '../data/prices'
+METADATA_PATH = '../data/metadata.parquet'
+METADATA_COLUMNS = ['Ticker', 'Short Name', 'Sector', 'Industry']
+# Company metadata barely changes; refresh_stocks refetches it this rarely.
+METADATA_FETCHED_AT = 'Fetched At'
+METADATA_TTL_DAYS = 7
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket: `rate` requests per second on average, bursts
+    of up to `capacity`.
+    '''
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=REQUEST_BURST,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+def retry(fn, attempts=RETRIES, backoff=None, sleep=time.sleep):
+    '''
+    Call fn(), retrying failures with exponential backoff and jitter;
+    backoff defaults to BACKOFF_SECONDS.
+    '''
+    if backoff is None:
+        backoff = BACKOFF_SECONDS
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+class PriceSource(ABC):
+    '''
+    Where prices and company metadata come from; a subclass missing either
+    method cannot be instantiated.
+    '''
+
+    @abstractmethod
+    def history(self, tickers, start, end):
+        '''
+        Return {<ticker>: <daily frame with a Date column>} for [start, end);
+        tickers without data are left out.
+        '''
+
+    @abstractmethod
+    def info(self, ticker):
+        '''
+        Return a dict with shortName, sector and industry.
+        '''
+
+
+class YahooSource(PriceSource):
+
+    def history(self, tickers, start, end):
+        import yfinance as yf
+
+        df = yf.download(tickers, start=start, end=end, group_by='ticker', actions=True,
+                         auto_adjust=True, ignore_tz=False, threads=False, progress=False)
+        out = {}
+        for t in tickers:
+            if df is None or t not in df.columns.get_level_values(0):
+                continue
+            hist = df[t].dropna(how='all')
+            if hist.empty:
+                continue
+            hist = hist.rename_axis('Date').reset_index()
+            hist.columns.name = None
+            out[t] = hist
+        return out
+
+    def info(self, ticker):
+        import yfinance as yf
+
+        return yf.Ticker(ticker).info
+
+
+class FakeSource(PriceSource):
+    '''
+    Deterministic offline prices (a random walk per ticker), for tests and
+    benchmarks. `latency` seconds are slept per call.
+    '''
+
+    def __init__(self, latency=0.0, sleep=time.sleep):
+        self.latency = latency
+        self._sleep = sleep
+        self.calls = 0
+
+    def history(self, tickers, start, end):
+        self.calls += 1
+        self._sleep(self.latency)
+        dates = pd.bdate_range(start, end, inclusive='left', tz='America/New_York')
+        out = {}
+        for t in tickers:
+            rng = np.random.default_rng(zlib.crc32(t.encode()))
+            # Anchor the walk on calendar days so overlapping windows agree.
+            days = (dates - pd.Timestamp('2000-01-03', tz='America/New_York')).days.to_numpy()
+            steps = rng.normal(size=(days[-1] + 1) if len(days) else 0)
+            close = 100 + np.cumsum(steps)[days]
+            out[t] = pd.DataFrame({
+                'Date': dates, 'Open': close, 'High': close, 'Low': close, 'Close': close,
+                'Volume': 1000, 'Dividends': 0.0, 'Stock Splits': 0.0,
+            })
+        return out
+
+    def info(self, ticker):
+        self.calls += 1
+        self._sleep(self.latency)
+        return {'shortName': f'{ticker} Inc.', 'sector': 'Sector', 'industry': 'Industry'}
+
+
+def fetch_stocks(tickers, start, end, source=None, workers=FETCH_WORKERS, limiter=None,
+                 batch_size=HISTORY_BATCH_SIZE, info_tickers=None):
+    '''
+    Fetch history for `tickers` in batches of `batch_size` and the info of
+    `info_tickers` (default: `tickers`), on a pool of `workers` threads sharing
+    `limiter` (a TokenBucket). Failed requests are retried with backoff.
+
+    Returns (<{ticker: history frame}>, <{ticker: info dict}>)
+    '''
+    source = YahooSource() if source is None else source
+    limiter = TokenBucket() if limiter is None else limiter
+
+    def limited(fn, *args):
+        def call():
+            limiter.acquire()
+            return fn(*args)
+        return retry(call)
+
+    info_tickers = tickers if info_tickers is None else info_tickers
+
+    history, info = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for lo in range(0, len(tickers), batch_size):
+            batch = list(tickers[lo:lo + batch_size])
+            futures[pool.submit(limited, source.history, batch, start, end)] = ('history', batch)
+        for t in info_tickers:
+            futures[pool.submit(limited, source.info, t)] = ('info', t)
+
+        for future in as_completed(futures):
+            kind, key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error with {kind} {key}: {e}")
+                continue
+            if kind == 'history':
+                history.update(result)
+            else:
+                info[key] = result
+    return history, info
+
+
+def combine(history, info):
+    '''
+    One flat frame with the metadata columns, like the old per-ticker loop.
+    '''
+    data = []
+    for t, hist in history.items():
+        meta = info.get(t, {})
+        hist = hist.copy()
+        hist['Ticker'] = t
+        hist['Short Name'] = meta.get('shortName', '')
+        hist['Sector'] = meta.get('sector', '')
+        hist['Industry'] = meta.get('industry', '')
+        data.append(hist)
+    return pd.concat(data, ignore_index=True)
+
 
 def get_tickers():
 
@@ -22,39 +238,177 @@ def get_tickers():
     return tickers
 
 
-def write_stocks(tickers, days_back, path="../data/current.csv"):
-    data = []
+def write_stocks(tickers, days_back, path=PRICES_PATH, metadata_path=METADATA_PATH,
+                 source=None, workers=FETCH_WORKERS, limiter=None):
+    '''
+    Fetch `days_back` days of prices for every ticker, see fetch_stocks.
 
+    A *.csv path writes the old flat CSV, with the metadata on every row;
+    anything else is written as a Parquet dataset partitioned by ticker, with
+    typed UTC dates, and the metadata once per ticker to `metadata_path`.
+    '''
     today = datetime.now(UTC)
     end_date = today.strftime('%Y-%m-%d')
     start_date = (today - timedelta(days=days_back)).strftime('%Y-%m-%d')
 
     print("Fetching price and metadata for each stock...")
-    for stock in tickers:
-        try:
-            ticker = yf.Ticker(stock)
-            hist = ticker.history(start=start_date, end=end_date)
-            if hist.empty:
-                continue
-            info = ticker.info
+    history, info = fetch_stocks(tickers, start_date, end_date, source=source,
+                                 workers=workers, limiter=limiter)
 
-            hist['Ticker'] = stock
-            hist['Short Name'] = info.get('shortName', '')
-            hist['Sector'] = info.get('sector', '')
-            hist['Industry'] = info.get('industry', '')
+    df_combined = combine(history, info)
+    if path.endswith('.csv'):
+        df_combined.to_csv(path, index=False)
+        return path
+
+    write_parquet(df_combined, path, metadata_path)
+    return path
 
-            hist.reset_index(inplace=True)
-            data.append(hist)
-            time.sleep(YAHOO_SLEEPINESS_SECONDS)
 
-        except Exception as e:
-            print(f"Error with {stock}: {e}")
+def write_parquet(df, path=PRICES_PATH, metadata_path=METADATA_PATH):
+    '''
+    Split a flat price frame into the Parquet price store and metadata table.
+    '''
+    metadata = df[METADATA_COLUMNS].drop_duplicates('Ticker')
+    metadata[METADATA_FETCHED_AT] = pd.Timestamp.now(tz='UTC')
+    metadata.to_parquet(metadata_path, index=False)
 
-    df_combined = pd.concat(data, ignore_index=True)
-    df_combined.to_csv(path, index=False)
+    prices = df.drop(columns=METADATA_COLUMNS[1:])
+    prices['Date'] = pd.to_datetime(prices['Date'], utc=True)
+    prices.to_parquet(path, index=False, partition_cols=['Ticker'],
+                      existing_data_behavior='delete_matching')
     return path
 
+
+def refresh_stocks(tickers, days_back, path=PRICES_PATH, metadata_path=METADATA_PATH,
+                   source=None, workers=FETCH_WORKERS, limiter=None,
+                   metadata_ttl=METADATA_TTL_DAYS, today=None):
+    '''
+    Bring the Parquet store up to date without refetching what it holds.
+
+    Each ticker's latest stored date is its high-water mark; only the days
+    after it are fetched, tickers sharing a mark in the same batches. Info is
+    refetched only for tickers whose metadata is older than `metadata_ttl`
+    days. Rows that fell out of the `days_back` window, and tickers no longer
+    in `tickers`, are evicted. An empty store is a full fetch.
+
+    Returns (<path>, <number of new rows>)
+    '''
+    today = datetime.now(UTC) if today is None else today
+    end_date = today.strftime('%Y-%m-%d')
+    window_start = pd.Timestamp(today - timedelta(days=days_back)).normalize()
+
+    stored = read_store(path)
+    marks = stored.groupby('Ticker')['Date'].max() if len(stored) else pd.Series(dtype=object)
+
+    # Group tickers by the first day they are missing.
+    starts = {}
+    for t in tickers:
+        start = window_start
+        if t in marks.index:
+            start = max(start, marks[t].normalize() + pd.Timedelta(days=1))
+        start = start.strftime('%Y-%m-%d')
+        if start < end_date:
+            starts.setdefault(start, []).append(t)
+
+    metadata = read_metadata(metadata_path)
+    fresh = metadata[metadata[METADATA_FETCHED_AT] >= pd.Timestamp(today) - timedelta(days=metadata_ttl)]
+    stale = [t for t in tickers if t not in set(fresh.Ticker)]
+
+    print(f"Fetching {len(starts)} delta range(s) and {len(stale)} stale metadata...")
+    history, info = {}, {}
+    for start, group in sorted(starts.items()):
+        h, _ = fetch_stocks(group, start, end_date, source=source, workers=workers,
+                            limiter=limiter, info_tickers=[])
+        history.update(h)
+    if stale:
+        _, info = fetch_stocks([], end_date, end_date, source=source, workers=workers,
+                               limiter=limiter, info_tickers=stale)
+
+    before = stored.groupby('Ticker').size() if len(stored) else pd.Series(dtype=int)
+    changed = set()
+    new = [hist.assign(Ticker=t) for t, hist in history.items() if len(hist)]
+    if new:
+        new = pd.concat(new, ignore_index=True)
+        new['Date'] = pd.to_datetime(new['Date'], utc=True)
+        changed.update(new.Ticker)
+        stored = pd.concat([stored, new], ignore_index=True) if len(stored) else new
+        stored = stored.drop_duplicates(['Ticker', 'Date'], keep='last')
+    if len(stored):
+        stored = stored[(stored['Date'] >= window_start) & stored.Ticker.isin(tickers)]
+    # Tickers that lost rows to the window, or all of them.
+    after = stored.groupby('Ticker').size() if len(stored) else pd.Series(dtype=int)
+    changed.update(t for t, n in before.items() if after.get(t, 0) != n)
+    # Untouched partitions keep their files, so source_hash and the app's
+    # snapshot stamp only change when the prices do.
+    if changed:
+        write_store(stored, path, tickers=changed)
+
+    kept = metadata.Ticker.isin(tickers)
+    if info:
+        rows = pd.DataFrame([{
+            'Ticker': t,
+            'Short Name': meta.get('shortName', ''),
+            'Sector': meta.get('sector', ''),
+            'Industry': meta.get('industry', ''),
+            METADATA_FETCHED_AT: pd.Timestamp(today),
+        } for t, meta in info.items()])
+        metadata = pd.concat([metadata[~metadata.Ticker.isin(rows.Ticker)], rows],
+                             ignore_index=True)
+    if info or not kept.all():
+        metadata = metadata[metadata.Ticker.isin(tickers)]
+        metadata.to_parquet(metadata_path, index=False)
+    return path, len(new)
+
+
+def read_store(path=PRICES_PATH):
+    '''
+    The Parquet price store as one frame, empty when it does not exist yet.
+    '''
+    if not os.path.isdir(path):
+        return pd.DataFrame()
+    df = pd.read_parquet(path)
+    df['Ticker'] = df['Ticker'].astype(str)
+    return df
+
+
+def read_metadata(metadata_path=METADATA_PATH):
+    '''
+    The metadata table; rows written without a fetch time count as stale.
+    '''
+    if not os.path.exists(metadata_path):
+        return pd.DataFrame(columns=METADATA_COLUMNS + [METADATA_FETCHED_AT])
+    metadata = pd.read_parquet(metadata_path)
+    if METADATA_FETCHED_AT not in metadata.columns:
+        metadata[METADATA_FETCHED_AT] = pd.NaT
+    metadata[METADATA_FETCHED_AT] = pd.to_datetime(metadata[METADATA_FETCHED_AT], utc=True)
+    return metadata
+
+
+def write_store(prices, path=PRICES_PATH, tickers=None):
+    '''
+    Rewrite the partitions of the tickers in `prices` and drop the partitions
+    of tickers that are gone.
+
+    tickers: only rewrite the partitions of these tickers, None for all of
+        them; the other partitions are left as they are on disk.
+    '''
+    keep = set(prices.Ticker) if len(prices) else set()
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name.startswith('Ticker=') and name[len('Ticker='):] not in keep:
+                shutil.rmtree(os.path.join(path, name))
+    if keep and tickers is not None:
+        prices = prices[prices.Ticker.isin(tickers)]
+    if len(prices):
+        prices.to_parquet(path, index=False, partition_cols=['Ticker'],
+                          existing_data_behavior='delete_matching')
+    return path
+
+
 if __name__ == '__main__':
     tickers = get_tickers()
-    path = write_stocks(tickers, STOCKS_DAYS_BACK)
+    if '--full' in sys.argv[1:] or PRICES_PATH.endswith('.csv'):
+        path = write_stocks(tickers, STOCKS_DAYS_BACK)
+    else:
+        path, rows = refresh_stocks(tickers, STOCKS_DAYS_BACK)
     print(f'wrote {path}; done.')
@@ -1,7 +1,24 @@
-from time import sleep
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from itertools import islice
+from datetime import (
+    datetime,
+    UTC,
+)
+from threading import Lock
+from time import (
+    monotonic,
+    sleep,
+)
+import csv
 import neo4j
 import os
 
+from .cache import LRUCache
+
 ### Set this in the envionment before you call the ip_session function,
 # using your shell:
 # $ export N4J_PW=password
@@ -9,86 +26,262 @@ import os
 # os.environ[OS_ENV_PW] = 'my secret password'
 OS_ENV_PW = 'N4J_PW'
 
-def ip_session(ip, db='neo4j'):
+### Connection pool settings for shared_driver, overridable from the environment.
+POOL_SIZE = int(os.environ.get('N4J_POOL_SIZE', 50))
+# Seconds to wait for a free connection before failing the request.
+POOL_ACQUISITION_TIMEOUT = float(os.environ.get('N4J_POOL_TIMEOUT', 30))
+# Ping connections that sat idle in the pool longer than this many seconds.
+LIVENESS_CHECK_TIMEOUT = float(os.environ.get('N4J_LIVENESS_TIMEOUT', 60))
+# Recycle connections older than this many seconds.
+MAX_CONNECTION_LIFETIME = float(os.environ.get('N4J_MAX_LIFETIME', 3600))
+
+def ip_driver(ip, **config):
     pw = os.environ.get(OS_ENV_PW, 'fake default password')
-    driver = neo4j.GraphDatabase.driver(uri="neo4j://{}:7687".format(ip), auth=("neo4j", pw))
-    return driver.session(database=db)
-
-LOAD_CORR_CSV_FMT = """
-        LOAD CSV WITH HEADERS FROM '{}' AS row
-        MERGE (a:Ticker {{ticker: row.a}})
-        MERGE (b:Ticker {{ticker: row.b}})
-        MERGE (a)-[r:REL {{weight: toFloat(row.weight), relationship: row.relationship}}]-(b)
+    return neo4j.GraphDatabase.driver(uri="neo4j://{}:7687".format(ip), auth=("neo4j", pw),
+                                      **config)
+
+def ip_session(ip, db='neo4j'):
+    return ip_driver(ip).session(database=db)
+
+_DRIVERS = {}
+_DRIVERS_LOCK = Lock()
+
+def shared_driver(ip):
+    """
+    Process-wide pooled driver for `ip`, created on first use. Sessions
+    borrowed from it are cheap; close them, not the driver, per request.
+    """
+    with _DRIVERS_LOCK:
+        driver = _DRIVERS.get(ip)
+        if driver is None:
+            driver = ip_driver(ip,
+                               max_connection_pool_size=POOL_SIZE,
+                               connection_acquisition_timeout=POOL_ACQUISITION_TIMEOUT,
+                               liveness_check_timeout=LIVENESS_CHECK_TIMEOUT,
+                               max_connection_lifetime=MAX_CONNECTION_LIFETIME)
+            _DRIVERS[ip] = driver
+        return driver
+
+def close_drivers():
+    """
+    Close every shared driver, eg. at process exit.
+    """
+    with _DRIVERS_LOCK:
+        for driver in _DRIVERS.values():
+            driver.close()
+        _DRIVERS.clear()
+
+### Queries bind values as $parameters, so each query text is planned once and
+# served from Neo4j's plan cache. Property names cannot be parameters; they are
+# checked with node_property and interpolated from a fixed set instead.
+
+LOAD_CORR_CSV = """
+        LOAD CSV WITH HEADERS FROM $fpath AS row
+        MERGE (a:Ticker {ticker: row.a})
+        MERGE (b:Ticker {ticker: row.b})
+        MERGE (a)-[r:REL {weight: toFloat(row.weight), relationship: row.relationship}]-(b)
+"""
+
+# Community properties written by build_louvain / build_leiden.
+COMMUNITY_PROPERTIES = ('community', 'leiden_community')
+
+SCHEMA = [
+    'CREATE CONSTRAINT ticker_unique IF NOT EXISTS FOR (n:Ticker) REQUIRE n.ticker IS UNIQUE',
+] + [
+    f'CREATE INDEX ticker_{p} IF NOT EXISTS FOR (n:Ticker) ON (n.{p})'
+    for p in COMMUNITY_PROPERTIES
+]
+
+def node_property(name):
+    """
+    Validate a node property name before it is interpolated into Cypher.
+    """
+    if not name.isidentifier():
+        raise ValueError(f'invalid node property: {name!r}')
+    return name
+
+### Client-side bulk loading, see Session.load_tickers and Session.load_edges
+BATCH_SIZE = 5000
+
+LOAD_TICKERS_UNWIND = """
+        UNWIND $rows AS row
+        MERGE (n:Ticker {ticker: row.ticker})
+        SET n.name = row.name,
+            n.sector = row.sector,
+            n.industry = row.industry
+"""
+
+LOAD_CORR_UNWIND = """
+        UNWIND $rows AS row
+        MERGE (a:Ticker {ticker: row.a})
+        MERGE (b:Ticker {ticker: row.b})
+        MERGE (a)-[r:REL {weight: row.weight, relationship: row.relationship}]-(b)
 """
 
-BUILD_LOUVAIN_FMT = '''
-        CALL gds.louvain.stream('{}', {{ relationshipWeightProperty: 'weight',
+SET_COMMUNITIES_UNWIND = """
+        UNWIND $rows AS row
+        MATCH (n:Ticker {ticker: row.ticker})
+        SET n.community = row.community,
+            n.leiden_community = row.leiden_community
+"""
+
+def read_rows(fpath):
+    """
+    Stream rows from a ticker (co.csv) or edge (pearson.csv) export as dicts;
+    edge weights are converted to floats.
+    """
+    with open(fpath, newline='') as f:
+        for row in csv.DictReader(f):
+            if 'weight' in row:
+                row['weight'] = float(row['weight'])
+            yield row
+
+def batched(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _run_batch(tx, query, rows):
+    return tx.run(query, rows=rows).consume().counters
+
+BUILD_LOUVAIN = '''
+        CALL gds.louvain.stream($name, { relationshipWeightProperty: 'weight',
         nodeLabels: ['*'],
-        maxLevels: {},
-        tolerance: {}
-        }})
+        maxLevels: $levels,
+        tolerance: $tolerance
+        })
         YIELD nodeId, communityId
         WITH gds.util.asNode(nodeId) AS node, communityId
         SET node.community = communityId
 '''
 
+### Graph build marker. build_graph stamps a new version after every rebuild;
+# caches of graph-derived results key on it.
+GRAPH_VERSION_QUERY = """
+        MATCH (v:GraphVersion {name: 'current'}) RETURN v.version
+"""
+SET_GRAPH_VERSION = """
+        MERGE (v:GraphVersion {name: 'current'})
+        SET v.version = $version
+        RETURN v.version
+"""
+# Seconds a process trusts the last version it read before asking again.
+VERSION_TTL_SECONDS = float(os.environ.get('N4J_VERSION_TTL', 30))
+
+class GraphVersion(object):
+    """
+    Memoize Session.graph_version() for `ttl` seconds.
+    """
+    def __init__(self, ttl=VERSION_TTL_SECONDS):
+        self.ttl = ttl
+        self._version = None
+        self._checked = None
+        self._lock = Lock()
+
+    def get(self, session):
+        with self._lock:
+            now = monotonic()
+            if self._checked is None or now - self._checked > self.ttl:
+                self._version = session.graph_version()
+                self._checked = now
+            return self._version
+
+    def invalidate(self):
+        with self._lock:
+            self._checked = None
+
+GRAPH_VERSION = GraphVersion()
+
+### Personalized PageRank, streamed without writing scores to the graph.
+STREAM_PPR = """
+        MATCH (source:Ticker {ticker: $ticker})
+        CALL gds.pageRank.stream($graph_name, {
+          maxIterations: $iterations,
+          dampingFactor: $damping_factor,
+          relationshipWeightProperty: 'weight',
+          sourceNodes: [source]
+        })
+        YIELD nodeId, score
+        WITH gds.util.asNode(nodeId) AS node, score
+        WHERE node.ticker <> $ticker
+        RETURN node.ticker AS ticker, score
+        ORDER BY score DESC
+        LIMIT $limit
+"""
+# Results kept per cached source ticker; larger requests bypass the cache.
+PPR_TOP_N = 100
+PPR_CACHE = LRUCache(int(os.environ.get('N4J_PPR_CACHE_SIZE', 512)))
+
 class Session(object):
-    def __init__(self, ip, db='neo4j'):
-        self.session = ip_session(ip, db)
+    def __init__(self, ip, db='neo4j', driver=None):
+        """
+        driver: borrow sessions from this driver, eg. shared_driver(ip);
+        by default the Session creates (and on close, closes) its own.
+        """
+        self._owns_driver = driver is None
+        self.driver = ip_driver(ip) if driver is None else driver
+        self.db = db
+        self.session = self.driver.session(database=db)
+
+    @classmethod
+    def shared(cls, ip, db='neo4j'):
+        return cls(ip, db, driver=shared_driver(ip))
+
+    def close(self):
+        self.session.close()
+        if self._owns_driver:
+            self.driver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def drop_all(self):
         return self.run('match (n) detach delete n return count(n)')
 
-
-    def load_ticker_csv(self, fpath='file:///user/co.csv'):
+    def ensure_schema(self):
         """
-        Loads Ticker nodes from CSV.
-
+        Create the :Ticker(ticker) uniqueness constraint and the community
+        property indexes, so MERGEs and lookups are index seeks.
         """
-        cmd = """
-        LOAD CSV WITH HEADERS FROM '{}' AS row
-        CREATE (n:Ticker {{
-        name: row.name,
-        ticker: row.ticker,
-        sector: row.sector,
-        industry: row.industry
-        }});
-        """.format(fpath)
-        return self.session.run(cmd)
-
-    def load_corr_csv(self, fpath='file:///user/pearson.csv', fmt_cmd=LOAD_CORR_CSV_FMT):
-        return self.run(fmt_cmd.format(fpath))
+        for cmd in SCHEMA:
+            self.run(cmd).consume()
 
     def remove_property(self, p='community'):
-        cmd = 'MATCH (n) REMOVE n.{} RETURN count(n) AS nodesUpdated'.format(p)
+        cmd = 'MATCH (n) REMOVE n.{} RETURN count(n) AS nodesUpdated'.format(node_property(p))
         return self.session.run(cmd)
 
     #### Louvain
     def get_community(self):
         query = '''
-        MATCH (n) return n.ticker, n.community
+        MATCH (n:Ticker) return n.ticker, n.community
         '''
         return self.run(query)
 
     def drop_projection(self, name="stock_picker"):
         try:
             remove = """
-            CALL gds.graph.drop('{}', true) yield graphName
-            """.format(name)
-            return self.session.run(remove)
+            CALL gds.graph.drop($name, true) yield graphName
+            """
+            return self.run(remove, {'name': name})
         except Exception as e:
             print(e)
 
 
     def create_projection(self, name='stock_picker'):
         create = """
-        CALL gds.graph.project('{}', 'Ticker', 'REL',
-                      {{relationshipProperties: 'weight'}})
-        """.format(name)
+        CALL gds.graph.project($name, 'Ticker', 'REL',
+                      {relationshipProperties: 'weight'})
+        """
         print('calling')
         print(create)
         try:
-            print(self.session.run(create).data())
+            print(self.run(create, {'name': name}).data())
         except Exception as e:
             print(e)
 
@@ -112,58 +305,116 @@ class Session(object):
         return self.create_projection(name)
 
     def build_louvain(self, levels=10, tolerance=1e-6, name='stock_picker',
-                      cmd_fmt=BUILD_LOUVAIN_FMT):
-
-        cmd = cmd_fmt.format(name, levels, tolerance)
-        return self.session.run(cmd)
-
-    def remove_property(self, p='community'):
-        cmd = 'MATCH (n) REMOVE n.{} RETURN count(n) AS nodesUpdated'.format(p)
-        return self.session.run(cmd)
+                      cmd=BUILD_LOUVAIN):
+        return self.run(cmd, {'name': name, 'levels': levels, 'tolerance': tolerance})
 
     def load_ticker_csv(self, fpath='file:///user/co.csv'):
-        cmd = f"""
-        LOAD CSV WITH HEADERS FROM '{fpath}' AS row
-        MERGE (n:Ticker {{
+        cmd = """
+        LOAD CSV WITH HEADERS FROM $fpath AS row
+        MERGE (n:Ticker {
             ticker: row.ticker
-        }})
+        })
         SET n.name = row.name,
             n.sector = row.sector,
             n.industry = row.industry
         """
-        return self.session.run(cmd)
+        return self.run(cmd, {'fpath': fpath})
 
-    def load_corr_csv(self, fpath='file:///user/pearson.csv', fmt_cmd=LOAD_CORR_CSV_FMT):
-        return self.run(fmt_cmd.format(fpath))
+    def load_corr_csv(self, fpath='file:///user/pearson.csv', cmd=LOAD_CORR_CSV):
+        return self.run(cmd, {'fpath': fpath})
+
+    #### Bulk loading from the client, no shared filesystem needed.
+    def load_tickers(self, rows, batch_size=BATCH_SIZE):
+        """
+        rows: iterable of {'ticker', 'name', 'sector', 'industry'} dicts,
+        eg. read_rows('../../data/export/co.csv')
+
+        Returns the number of rows sent.
+        """
+        return self.load_batches(LOAD_TICKERS_UNWIND, rows, batch_size)
+
+    def load_edges(self, rows, batch_size=BATCH_SIZE, workers=1):
+        """
+        rows: iterable of {'a', 'b', 'relationship', 'weight'} dicts,
+        eg. read_rows('../../data/pearson.csv')
+        workers: number of batches in flight at once. Load the tickers first
+        when using more than one, so the node MERGEs only ever match.
+
+        Returns the number of rows sent.
+        """
+        return self.load_batches(LOAD_CORR_UNWIND, rows, batch_size, workers)
+
+    def set_communities(self, rows, batch_size=BATCH_SIZE):
+        """
+        rows: iterable of {'ticker', 'community', 'leiden_community'} dicts,
+        eg. from communities.detect, computed without GDS.
+
+        Returns the number of rows sent.
+        """
+        return self.load_batches(SET_COMMUNITIES_UNWIND, rows, batch_size)
+
+    def load_batches(self, query, rows, batch_size=BATCH_SIZE, workers=1):
+        """
+        Send rows as `$rows` to `query` in batches of `batch_size`, one explicit
+        write transaction per batch (retried on transient errors, eg. deadlocks).
+        At most 2 * workers batches are held in memory at a time.
+        """
+        sent = 0
+        if workers <= 1:
+            for batch in batched(rows, batch_size):
+                self.session.execute_write(_run_batch, query, batch)
+                sent += len(batch)
+            return sent
+
+        def load(batch):
+            with self.driver.session(database=self.db) as session:
+                session.execute_write(_run_batch, query, batch)
+            return len(batch)
+
+        pending = set()
+        batches = batched(rows, batch_size)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                # Make room before reading the next batch, not after.
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    sent += sum(f.result() for f in done)
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.add(pool.submit(load, batch))
+            sent += sum(f.result() for f in pending)
+        return sent
 
     # Leiden
     def reset_projection_for_leiden(self, name="stock_picker"):
         remove = """
-        CALL gds.graph.drop('{}', false) yield graphName
-        """.format(name)
+        CALL gds.graph.drop($name, false) yield graphName
+        """
         try:
-            self.run(remove)
+            self.run(remove, {'name': name})
         except Exception as e:
             print(e)
 
         create = """
-        CALL gds.graph.project('{}', 'Ticker', {{ REL: {{ orientation: 'UNDIRECTED', properties: 'weight' }} }})
-        """.format(name)
-        return self.run(create)
+        CALL gds.graph.project($name, 'Ticker', { REL: { orientation: 'UNDIRECTED', properties: 'weight' } })
+        """
+        return self.run(create, {'name': name})
 
-    def build_leiden(self, name='stock_picker'):
+    def build_leiden(self, name='stock_picker', gamma=1.075, min_community_size=5):
         query = """
-        CALL gds.leiden.stream('{}', {{
+        CALL gds.leiden.stream($name, {
           relationshipWeightProperty: 'weight',
           nodeLabels: ['*'],
-          gamma: 1.075,          // increased resolution parameter
-          minCommunitySize: 5
-        }})
+          gamma: $gamma,          // increased resolution parameter
+          minCommunitySize: $min_community_size
+        })
         YIELD nodeId, communityId, intermediateCommunityIds
         WITH gds.util.asNode(nodeId) AS node, communityId
         SET node.leiden_community = communityId
-        """.format(name)
-        return self.run(query)
+        """
+        return self.run(query, {'name': name, 'gamma': gamma,
+                                'min_community_size': min_community_size})
 
     # PageRank Algo
     def run_personalized_pagerank(self, source_ticker, name='stock_picker', damping_factor=0.85, iterations=20):
@@ -173,24 +424,24 @@ class Session(object):
         The scores are stored on each node as 'personalizedPageRank' and the procedure returns (ticker, score).
         """
 
-        node_query = f"""
-        MATCH (n:Ticker {{ticker: '{source_ticker}'}})
+        node_query = """
+        MATCH (n:Ticker {ticker: $ticker})
         RETURN id(n) AS nodeId
         """
 
         print("Using ticker: ", source_ticker)
-        result = self.session.run(node_query).single()
+        result = self.run(node_query, {'ticker': source_ticker}).single()
         if not result:
             raise ValueError(f"Ticker '{source_ticker}' not found in the graph.")
         source_node_id = result["nodeId"]
 
-        query = f"""
-        CALL gds.pageRank.stream($graph_name, {{
+        query = """
+        CALL gds.pageRank.stream($graph_name, {
           maxIterations: $iterations,
           dampingFactor: $damping_factor,
           relationshipWeightProperty: 'weight',
           sourceNodes: $source_nodes
-        }})
+        })
         YIELD nodeId, score
         WITH gds.util.asNode(nodeId) AS node, score
         SET node.personalizedPageRank = score
@@ -204,55 +455,98 @@ class Session(object):
             "source_nodes": [source_node_id]
         }
 
-        return self.session.run(query, params).data()
+        return self.run(query, params).data()
+
+    def stream_personalized_pagerank(self, source_ticker, top_n=PPR_TOP_N, name='stock_picker',
+                                     damping_factor=0.85, iterations=20):
+        """
+        Read-only personalized PageRank: the top N tickers (excluding the
+        source) as [{'ticker', 'score'}, ...], best first. Nothing is written
+        to the graph, so concurrent requests do not interfere.
+        """
+        params = {
+            "ticker": source_ticker,
+            "graph_name": name,
+            "iterations": iterations,
+            "damping_factor": damping_factor,
+            "limit": top_n,
+        }
+        return self.run(STREAM_PPR, params).data()
+
+    def cached_personalized_pagerank(self, source_ticker, top_n=10, name='stock_picker',
+                                     damping_factor=0.85, iterations=20):
+        """
+        stream_personalized_pagerank behind PPR_CACHE, keyed by
+        (source ticker, damping, iterations, graph version).
+        """
+        if top_n > PPR_TOP_N:
+            return self.stream_personalized_pagerank(source_ticker, top_n, name,
+                                                     damping_factor, iterations)
+
+        key = (source_ticker, damping_factor, iterations, GRAPH_VERSION.get(self))
+        scores = PPR_CACHE.get(key)
+        if scores is None:
+            scores = self.stream_personalized_pagerank(source_ticker, PPR_TOP_N, name,
+                                                       damping_factor, iterations)
+            PPR_CACHE.put(key, scores)
+        return scores[:top_n]
+
+    def graph_version(self):
+        """
+        The version stamped by the last graph build, or None.
+        """
+        record = self.run(GRAPH_VERSION_QUERY).single()
+        return record[0] if record else None
+
+    def set_graph_version(self, version=None):
+        """
+        Stamp a new graph version, by default the current UTC time.
+        """
+        if version is None:
+            version = datetime.now(UTC).isoformat()
+        self.run(SET_GRAPH_VERSION, {'version': version}).consume()
+        GRAPH_VERSION.invalidate()
+        return version
 
     def get_all_similar_by_ppr(self, source_ticker):
         """
         Return all tickers (excluding source_ticker) sorted descending by personalizedPageRank.
         """
-        query = f"""
+        query = """
         MATCH (n:Ticker)
-        WHERE n.personalizedPageRank IS NOT NULL AND n.ticker <> '{source_ticker}'
+        WHERE n.personalizedPageRank IS NOT NULL AND n.ticker <> $ticker
         RETURN n.ticker AS ticker, n.personalizedPageRank AS score
         ORDER BY score DESC
         """
-        return self.session.run(query).data()
+        return self.run(query, {'ticker': source_ticker}).data()
 
     def get_top_similar_by_ppr(self, source_ticker, top_n=10):
         """
-        Runs personalized PageRank for the source ticker (if not already run) and then returns
-        the top N tickers (excluding the source ticker) sorted in descending order by their personalizedPageRank scores.
+        Returns the top N tickers (excluding the source ticker) sorted in descending order by
+        their personalized PageRank scores, see cached_personalized_pagerank.
         """
-        self.run_personalized_pagerank(source_ticker)
-
-        query = f"""
-        MATCH (n:Ticker)
-        WHERE n.personalizedPageRank IS NOT NULL AND n.ticker <> '{source_ticker}'
-        RETURN n.ticker AS ticker, n.personalizedPageRank AS score
-        ORDER BY score DESC
-        LIMIT {top_n}
-        """
-        return self.session.run(query).data()
+        return self.cached_personalized_pagerank(source_ticker, top_n)
 
     def get_bottom_similar_by_ppr(self, source_ticker, bottom_n=5):
         """
         Returns the bottom N tickers (excluding the source ticker) sorted in ascending order by their personalizedPageRank.
         """
-        query = f"""
+        query = """
         MATCH (n:Ticker)
-        WHERE n.personalizedPageRank IS NOT NULL AND n.ticker <> '{source_ticker}'
+        WHERE n.personalizedPageRank IS NOT NULL AND n.ticker <> $ticker
         RETURN n.ticker AS ticker, n.personalizedPageRank AS score
         ORDER BY score ASC
-        LIMIT {bottom_n}
+        LIMIT $limit
         """
-        return self.session.run(query).data()
+        return self.run(query, {'ticker': source_ticker, 'limit': bottom_n}).data()
 
 
     def count_nodes(self, name='Ticker'):
         return self.run('match (n:Ticker) return count(n)')
 
     def unique_property(self, prop='community'):
-        q = f'MATCH (n) return distinct(n.{prop}), count(n.{prop})'
+        prop = node_property(prop)
+        q = f'MATCH (n:Ticker) return distinct(n.{prop}), count(n.{prop})'
         return self.run(q)
 
     def get_similar(self, ticker, nproperty='community'):
@@ -262,27 +556,27 @@ class Session(object):
         Return the tickers with the same `nproperty` id
         '''
         query = '''
-        match (n) where n.ticker = "{ticker}"
+        match (n:Ticker {{ticker: $ticker}})
         with n.{nproperty} as community_id
-        match (m) where m.{nproperty} = community_id
+        match (m:Ticker) where m.{nproperty} = community_id
         return m.ticker
-        '''.format(ticker=ticker, nproperty=nproperty)
-        return self.run(query).value()
+        '''.format(nproperty=node_property(nproperty))
+        return self.run(query, {'ticker': ticker}).value()
 
     def get_groups(self, ticker, nproperty='community'):
         '''
         ticker: stock ticker, eg., APPL
 
-        Return the tickers with the same `nproperty` id
+        Return [<group id>, <ticker>] for every ticker, grouped by `nproperty`
         '''
         query = '''
-        match (m)
+        match (m:Ticker)
         return m.{nproperty} as group_id, m.ticker as ticker
-        '''.format(ticker=ticker, nproperty=nproperty)
+        '''.format(nproperty=node_property(nproperty))
         return self.run(query).values()
 
-    def run(self, query):
-        return self.session.run(query)
+    def run(self, query, params=None):
+        return self.session.run(query, params)
 
-    def list_projections():
+    def list_projections(self):
         return self.run('CALL gds.graph.list()').values()
@@ -13,29 +13,52 @@ if __name__ == '__main__':
     session.drop_all()
     print("Complete")
 
+    print("Creating constraints and indexes...")
+    session.ensure_schema()
+    print("Complete")
+
+    batch_size = int(os.environ.get("N4J_BATCH_SIZE", BATCH_SIZE))
+    workers = int(os.environ.get("N4J_WORKERS", 1))
+
     print("Loading ticker csv...")
-    session.load_ticker_csv()
-    print("Complete.")
+    n = session.load_tickers(read_rows(os.environ.get("CO_CSV", "../../data/export/co.csv")),
+                             batch_size=batch_size)
+    print(f"Complete; {n} tickers.")
 
     print("Loading correlation csv...")
-    session.load_corr_csv()
-    print("Complete.")
+    n = session.load_edges(read_rows(os.environ.get("CORR_CSV", "../../data/pearson.csv")),
+                           batch_size=batch_size, workers=workers)
+    print(f"Complete; {n} edges.")
+
+    if os.environ.get("NATIVE_COMMUNITIES"):
+        # Detect communities in-process instead of with GDS projections.
+        from communities import detect, read_edges
+
+        print("Detecting louvain and leiden communities...")
+        adjacency, names = read_edges(os.environ.get("CORR_CSV", "../../data/pearson.csv"))
+        found = detect(adjacency, names).astype(object)
+        found = found.where(found.notna(), None)
+        n = session.set_communities(found.to_dict('records'), batch_size=batch_size)
+        print(f"Complete; {n} tickers.")
+    else:
+        print("Creating projection...")
+        session.create_projection()
+        print("Complete.")
 
-    print("Creating projection...")
-    session.create_projection()
-    print("Complete.")
+        print("Building louvain...")
+        session.build_louvain()
+        print("Complete.")
 
-    print("Building louvain...")
-    session.build_louvain()
-    print("Complete.")
+        print("Resetting projection for leiden...")
+        session.reset_projection_for_leiden()
+        print("Complete.")
 
-    print("Resetting projection for leiden...")
-    session.reset_projection_for_leiden()
-    print("Complete.")
+        print("Building leiden...")
+        session.build_leiden()
+        print("Complete.")
 
-    print("Building leiden...")
-    session.build_leiden()
-    print("Complete.")
+    print("Stamping graph version...")
+    print(f"Complete; version {session.set_graph_version()}.")
 
     print("Graph setup complete.")
     print("***********")
@@ -0,0 +1,108 @@
+from threading import Lock
+
+from . import (
+    COMMUNITY_PROPERTIES,
+    GRAPH_VERSION,
+)
+
+
+class Memberships(object):
+    '''
+    Immutable community memberships for one graph version:
+    per node property, group id -> member tickers and ticker -> group id.
+    '''
+
+    def __init__(self, groupings_by_prop, version=None):
+        '''
+        groupings_by_prop: {<property>: [[<group id>, <ticker>], ...]},
+        eg. from graph.Session.get_groups or communities.groupings
+        '''
+        self.version = version
+        self._members = {}
+        self._group_of = {}
+        for prop, groupings in groupings_by_prop.items():
+            members, group_of = {}, {}
+            for gid, ticker in groupings:
+                members.setdefault(gid, []).append(ticker)
+                group_of[ticker] = gid
+            self._members[prop] = members
+            self._group_of[prop] = group_of
+
+    def __contains__(self, prop):
+        return prop in self._members
+
+    def with_property(self, prop, groupings):
+        '''
+        A copy that also holds `prop`.
+        '''
+        out = Memberships({}, self.version)
+        out._members = dict(self._members)
+        out._group_of = dict(self._group_of)
+        loaded = Memberships({prop: groupings})
+        out._members[prop] = loaded._members[prop]
+        out._group_of[prop] = loaded._group_of[prop]
+        return out
+
+    def similar(self, ticker, prop='community'):
+        '''
+        Tickers sharing `ticker`'s group id, like graph.Session.get_similar;
+        none for tickers without one (eg. below the leiden minimum size).
+        '''
+        gid = self._group_of[prop].get(ticker)
+        if gid is None:
+            return []
+        return list(self._members[prop][gid])
+
+    def grouped(self, ticker, prop='community'):
+        '''
+        Every group, the target's first; same output as
+        StocksFeatures.collect_groups over Session.get_groups.
+        '''
+        target_gid = self._group_of[prop].get(ticker, object())
+        target_blob = {}
+        out = []
+        for gid, tickers in self._members[prop].items():
+            if gid == target_gid:
+                target_blob = {'ticker': ticker, 'group': gid, 'similar': list(tickers)}
+                continue
+            out.append({'group': gid, 'similar': list(tickers)})
+        return [target_blob] + out
+
+    def assignments(self, prop='community'):
+        '''
+        [(<ticker>, <group id>), ...]
+        '''
+        return list(self._group_of[prop].items())
+
+
+class MembershipIndex(object):
+    '''
+    Serves Memberships from process memory; reloads them from Neo4j only
+    when the graph version marker changes, see graph.GraphVersion.
+    '''
+
+    def __init__(self, properties=COMMUNITY_PROPERTIES, version=GRAPH_VERSION):
+        self.properties = tuple(properties)
+        self._version = version
+        self._current = None
+        self._lock = Lock()
+
+    def get(self, session, prop=None):
+        '''
+        session: graph.Session, used only to check the version and to load.
+        prop: make sure this property is loaded too.
+        '''
+        version = self._version.get(session)
+        current = self._current
+        if current is not None and current.version == version and (prop is None or prop in current):
+            return current
+
+        with self._lock:
+            current = self._current
+            if current is None or current.version != version:
+                current = Memberships({p: session.get_groups(None, nproperty=p)
+                                       for p in self.properties}, version)
+            if prop is not None and prop not in current:
+                current = current.with_property(prop, session.get_groups(None, nproperty=prop))
+            self._current = current
+            return current
@@ -1,45 +1,133 @@
-import pandas as pd
+'''
+Minimum spanning tree (and filtered-graph variants) of the correlation
+graph, as an edge list for graph.Session.load_corr_csv / load_edges.
+
+The tree is extracted sparse: no dense copy of the result and no n x n
+Python loop, so universes of thousands of tickers take seconds.
+
+$ PYTHONPATH=. python3 mst.py ../data/sp500_metadata.csv ../data/pearson_mst.csv [<k>]
+
+With <k>, each ticker's k most correlated neighbours are added to the tree.
+'''
+import sys
+
 import numpy as np
+import pandas as pd
+from scipy import sparse
 from scipy.sparse.csgraph import minimum_spanning_tree
 
-# Step 1: Load time series from sp500_metadata.csv #
-df = pd.read_csv("../data/sp500_metadata.csv")  # assumed to have 'Date', 'Ticker', 'Close'
+from features import (
+    MISSING_ALIGN,
+    NEIGHBOURS_BLOCK_ROWS,
+    StocksFeatures,
+    top_k,
+)
+
+MST = 'MST'
+KNN = 'KNN'
+# Perfectly correlated pairs are distance 0, which scipy reads as "no edge".
+MIN_DISTANCE = 1e-12
+COLUMNS = ['a', 'b', 'weight', 'relationship']
+
+
+def log_return_corr(sf):
+    '''
+    Pearson correlation of daily log returns of the tickers with a close on
+    every trading day; tickers with gaps are left out rather than filled, as
+    the tree has always been built. Read `sf` with missing=MISSING_ALIGN so
+    the gaps are still there.
+
+    Returns (<(n, n) correlation>, <the n tickers>).
+    '''
+    prices = sf.price_matrix()
+    keep = np.flatnonzero(~np.isnan(prices).any(axis=0))
+    returns = sf.returns_matrix(log=True)[keep]
+    return np.corrcoef(returns), [sf.name(ix) for ix in keep]
+
+
+def mst_tree(corr):
+    '''
+    corr: (n, n) correlation matrix, eg. StocksFeatures.pearson()
+
+    Return the MST of the distance 2 * (1 - corr) as (rows, cols), one
+    entry per tree edge.
+    '''
+    dist = np.maximum(2 * (1 - np.asarray(corr, dtype=np.float64)), MIN_DISTANCE)
+    np.fill_diagonal(dist, 0)  # prevent self-loops
+    tree = minimum_spanning_tree(dist).tocoo()
+    return tree.row, tree.col
+
+
+def knn_pairs(corr, k):
+    '''
+    Each ticker paired with its k most correlated neighbours, computed in row
+    blocks; returns (rows, cols).
+    '''
+    n = corr.shape[0]
+    rows, cols = [], []
+    for lo in range(0, n, NEIGHBOURS_BLOCK_ROWS):
+        hi = min(lo + NEIGHBOURS_BLOCK_ROWS, n)
+        ids, _ = top_k(corr[lo:hi], k, row_ids=np.arange(lo, hi))
+        rows.append(np.repeat(np.arange(lo, hi), ids.shape[1]))
+        cols.append(ids.ravel())
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def edge_frame(corr, names, rows, cols, relationship):
+    names = np.asarray(names, dtype=object)
+    return pd.DataFrame({
+        'a': names[rows],
+        'b': names[cols],
+        'weight': np.asarray(corr)[rows, cols],
+        'relationship': relationship,
+    }, columns=COLUMNS)
+
 
-# Pivot: rows = dates, columns = tickers, values = prices
-price_df = df.pivot(index='Date', columns='Ticker', values='Close').sort_index()
+def mst_edges(corr, names):
+    '''
+    MST edges with their correlation as the weight.
+    '''
+    rows, cols = mst_tree(corr)
+    return edge_frame(corr, names, rows, cols, MST)
 
-# Drop tickers with missing values
-price_df = price_df.dropna(axis=1)
 
-# Step 2: Calculate log returns #
-returns = np.log(price_df / price_df.shift(1)).dropna()
+def mst_knn_edges(corr, names, k=5):
+    '''
+    Union of the MST with every ticker's k nearest neighbours; pairs already
+    in the tree keep the MST relationship, each undirected pair appears once.
+    '''
+    n = corr.shape[0]
+    t_rows, t_cols = mst_tree(corr)
+    k_rows, k_cols = knn_pairs(corr, k)
 
-# Step 3: Compute Pearson correlation matrix #
-corr_matrix = returns.corr()
+    # Key undirected pairs as (min, max) in a sparse matrix; the tree wins.
+    def upper(r, c, v):
+        return sparse.coo_matrix((v, (np.minimum(r, c), np.maximum(r, c))), shape=(n, n)).tocsr()
 
-# Step 4: Convert to distance matrix #
-distance_matrix = 2 * (1 - corr_matrix)
-np.fill_diagonal(distance_matrix.values, np.inf)  # prevent self-loops
+    tree = upper(t_rows, t_cols, np.ones(len(t_rows)))
+    tree.data[:] = 1
+    knn = upper(k_rows, k_cols, np.ones(len(k_rows)))
+    knn.data[:] = 1
+    extra = (knn - knn.multiply(tree)).tocoo()
+    extra.eliminate_zeros()
 
-# Step 5: Apply Minimum Spanning Tree (MST) #
-mst = minimum_spanning_tree(distance_matrix.values).toarray()
+    return pd.concat([
+        edge_frame(corr, names, t_rows, t_cols, MST),
+        edge_frame(corr, names, extra.row, extra.col, KNN),
+    ], ignore_index=True)
 
-# Step 6: Convert MST back to correlation edges #
-tickers = corr_matrix.columns.to_list()
-edges = []
 
-for i in range(len(tickers)):
-    for j in range(len(tickers)):
-        if mst[i, j] > 0:
-            corr = 1 - (mst[i, j] / 2)
-            edges.append({
-                'a': tickers[i],
-                'b': tickers[j],
-                'weight': corr,
-                'relationship': 'MST'
-            })
+if __name__ == '__main__':
+    src = sys.argv[1] if len(sys.argv) > 1 else '../data/sp500_metadata.csv'
+    out = sys.argv[2] if len(sys.argv) > 2 else '../data/pearson_mst.csv'
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 0
 
-edges_df = pd.DataFrame(edges)
-edges_df.to_csv("../data/pearson_mst.csv", index=False)
+    sf = StocksFeatures.read_prices(src, missing=MISSING_ALIGN)
+    corr, names = log_return_corr(sf)
+    if k:
+        edges_df = mst_knn_edges(corr, names, k)
+    else:
+        edges_df = mst_edges(corr, names)
+    edges_df.to_csv(out, index=False)
 
-print(f"Created MST edge list with {len(edges)} edges → saved to data/pearson_mst.csv")
+    print(f"Created MST edge list with {len(edges_df)} edges → saved to {out}")
@@ -0,0 +1,163 @@
+'''
+In-process personalized PageRank over the correlation graph export
+(data/pearson.csv), without a Neo4j GDS projection.
+
+Scores follow gds.pageRank with sourceNodes: every iteration each node keeps
+(1 - damping) of the teleport mass of its sources plus damping times the
+weight-normalized scores flowing in over its edges, for at most
+`iterations` rounds or until no score moves by more than `tolerance`.
+
+Precompute the full source x target table offline:
+
+$ python3 pagerank.py ../data/pearson.csv ../data/ppr
+
+'''
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from features.artifacts import (
+    read_artifacts,
+    source_hash,
+    write_artifacts,
+)
+
+DAMPING_FACTOR = 0.85
+MAX_ITERATIONS = 20
+TOLERANCE = 1e-7
+# Sources iterated together in one sparse x dense product.
+SOURCE_BATCH = 512
+
+
+class PersonalizedPageRank(object):
+
+    @classmethod
+    def from_edges_csv(cls, path, undirected=True):
+        '''
+        path: edge export with a, b, weight columns, see
+        StocksFeatures.export_graph
+        undirected: follow every edge both ways, like the projection made by
+        graph.Session.reset_projection_for_leiden.
+        '''
+        edges = pd.read_csv(path, usecols=['a', 'b', 'weight'])
+        return cls.from_edges(edges.a.to_numpy(), edges.b.to_numpy(),
+                              edges.weight.to_numpy(dtype=np.float64), undirected)
+
+    @classmethod
+    def from_edges(cls, a, b, weight, undirected=True):
+        names, codes = np.unique(np.concatenate([a, b]), return_inverse=True)
+        src, dst = codes[:len(a)], codes[len(a):]
+        if undirected:
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+            weight = np.concatenate([weight, weight])
+        n = len(names)
+        adjacency = sparse.csr_matrix((weight, (src, dst)), shape=(n, n))
+        return cls(adjacency, names.tolist())
+
+    def __init__(self, adjacency, names):
+        '''
+        adjacency: (n, n) sparse weights, row = source node.
+        names: ticker for each row.
+        '''
+        self.names = list(names)
+        self._ix = {name: ix for ix, name in enumerate(self.names)}
+
+        out_weight = np.asarray(adjacency.sum(axis=1)).ravel()
+        inv = np.divide(1.0, out_weight, out=np.zeros_like(out_weight), where=out_weight > 0)
+        # Row-stochastic transition matrix; dangling rows stay empty, as in GDS.
+        transition = sparse.diags(inv) @ adjacency
+        # scores @ P == (P.T @ scores.T).T, kept as CSR for sparse x dense.
+        self._transition_t = sparse.csr_matrix(transition.T)
+
+    def ix(self, name):
+        return self._ix[name]
+
+    def scores(self, sources, damping_factor=DAMPING_FACTOR, iterations=MAX_ITERATIONS,
+               tolerance=TOLERANCE):
+        '''
+        sources: tickers to personalize on, one result row each.
+
+        Return (<num sources>, <num nodes>) scores, batched into a single
+        sparse x dense product per iteration.
+        '''
+        rows = np.array([self.ix(s) for s in sources], dtype=np.int64)
+        n = len(self.names)
+        teleport = np.zeros((n, len(rows)))
+        teleport[rows, np.arange(len(rows))] = 1.0 - damping_factor
+
+        x = teleport.copy()
+        for _ in range(iterations):
+            nxt = teleport + damping_factor * (self._transition_t @ x)
+            delta = np.abs(nxt - x).max() if x.size else 0.0
+            x = nxt
+            if delta < tolerance:
+                break
+        return x.T
+
+    def table(self, damping_factor=DAMPING_FACTOR, iterations=MAX_ITERATIONS,
+              tolerance=TOLERANCE, batch=SOURCE_BATCH, dtype=np.float32):
+        '''
+        The full source x target score table, computed `batch` sources at a time.
+        '''
+        n = len(self.names)
+        out = np.empty((n, n), dtype=dtype)
+        for lo in range(0, n, batch):
+            hi = min(lo + batch, n)
+            out[lo:hi] = self.scores(self.names[lo:hi], damping_factor, iterations, tolerance)
+        return out
+
+
+class PageRankTable(object):
+    '''
+    Precomputed source x target scores; answers as a row lookup.
+    '''
+
+    @classmethod
+    def cached(cls, edges_path, out_dir, damping_factor=DAMPING_FACTOR,
+               iterations=MAX_ITERATIONS):
+        '''
+        Memory-map the table in `out_dir` when it was built from the current
+        `edges_path` with the same settings, otherwise compute and save it.
+        '''
+        digest = source_hash(edges_path)
+        settings = {'damping_factor': damping_factor, 'iterations': iterations}
+        arrays = read_artifacts(out_dir, digest, settings)
+        if arrays is not None:
+            return cls(arrays['scores'], arrays['names'].tolist())
+
+        ppr = PersonalizedPageRank.from_edges_csv(edges_path)
+        table = cls(ppr.table(damping_factor, iterations), ppr.names)
+        write_artifacts({'names': np.array(table.names, dtype=str), 'scores': table.scores},
+                        out_dir, digest, settings)
+        return table
+
+    def __init__(self, scores, names):
+        self.scores = scores
+        self.names = list(names)
+        self._ix = {name: ix for ix, name in enumerate(self.names)}
+
+    def __contains__(self, name):
+        return name in self._ix
+
+    def top(self, source, n=10):
+        '''
+        Return [{'ticker', 'score'}, ...] for the top n targets (excluding the
+        source), like graph.Session.stream_personalized_pagerank.
+        '''
+        ix = self._ix[source]
+        row = np.asarray(self.scores[ix], dtype=np.float64).copy()
+        row[ix] = -np.inf
+        n = min(n, len(row) - 1)
+        if n <= 0:
+            return []
+        best = np.argpartition(-row, n - 1)[:n]
+        best = best[np.argsort(-row[best], kind='stable')]
+        return [{'ticker': self.names[i], 'score': float(row[i])} for i in best]
+
+
+if __name__ == '__main__':
+    src, out = sys.argv[1], sys.argv[2]
+    table = PageRankTable.cached(src, out)
+    print(f'{len(table.names)} sources; table in {out}; done.')
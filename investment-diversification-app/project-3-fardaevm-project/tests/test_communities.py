@@ -0,0 +1,51 @@
+import numpy as np
+from scipy import sparse
+
+from communities import (
+    LEIDEN,
+    LOUVAIN,
+    detect,
+    groupings,
+    leiden,
+    louvain,
+)
+
+
+def planted(sizes=(6, 6, 2), seed=0):
+    '''
+    Dense weighted blocks joined by a few weak edges.
+    '''
+    rng = np.random.default_rng(seed)
+    n = sum(sizes)
+    block = np.repeat(np.arange(len(sizes)), sizes)
+    same = block[:, None] == block[None, :]
+    w = np.where(same, rng.uniform(800, 1000, (n, n)), rng.uniform(0, 1, (n, n)) < 0.05)
+    w = np.triu(w, k=1)
+    return sparse.csr_matrix(w + w.T), block
+
+
+def test_louvain_and_leiden_recover_planted_blocks():
+    adjacency, block = planted()
+    for membership in (louvain(adjacency), leiden(adjacency, min_community_size=1)):
+        # Same partition as the planted one, up to relabelling.
+        pairs = set(zip(block.tolist(), membership.tolist()))
+        assert len(pairs) == len(set(block.tolist())) == len(set(membership.tolist()))
+
+
+def test_leiden_min_community_size_and_seed():
+    adjacency, block = planted()
+    membership = leiden(adjacency, min_community_size=5)
+    assert (membership[block == 2] == -1).all()
+    assert (membership[block != 2] >= 0).all()
+    np.testing.assert_array_equal(louvain(adjacency, seed=7), louvain(adjacency, seed=7))
+
+
+def test_detect_feeds_groupings():
+    adjacency, _ = planted()
+    names = [f'T{i:02d}' for i in range(adjacency.shape[0])]
+    found = detect(adjacency, names)
+    assert list(found.columns) == ['ticker', LOUVAIN, LEIDEN]
+
+    groups = groupings(found, LEIDEN)
+    assert [t for _, t in groups] == names
+    assert groups[-1][0] is None
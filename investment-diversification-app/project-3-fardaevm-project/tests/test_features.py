@@ -0,0 +1,309 @@
+import numpy as np
+import pandas as pd
+
+from features import (
+    StocksFeatures,
+    MISSING_ALIGN,
+    MISSING_DROP,
+)
+
+
+def make_prices(tickers=('AAA', 'BBB', 'CCC', 'DDD'), days=30, seed=0):
+    '''
+    Long-format price history like data/current.csv.
+    '''
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2025-01-02', periods=days)
+    rows = []
+    for t in tickers:
+        closes = 100 + np.cumsum(rng.normal(size=days))
+        for d, c in zip(dates, closes):
+            rows.append((d, c, t, f'{t} Inc', 'Sector', 'Industry'))
+    return pd.DataFrame(rows, columns=['Date', 'Close', 'Ticker', 'Short Name',
+                                       'Sector', 'Industry'])
+
+
+def test_diff_matrix_matches_per_ticker_diff():
+    df = make_prices()
+    sf = StocksFeatures(df)
+    dm = sf.diff_matrix()
+    assert dm.shape == (4, 29)
+    for ix, name in enumerate(sf.names()):
+        expected = df.loc[df.Ticker == name].Close.diff()[1:].to_numpy()
+        np.testing.assert_allclose(dm[ix], expected)
+
+
+def test_diff_matrix_missing_days():
+    df = make_prices()
+    # BBB misses its third trading day.
+    missing = df.loc[df.Ticker == 'BBB'].index[2]
+    ragged = df.drop(missing)
+
+    ffilled = StocksFeatures(ragged).diff_matrix()
+    assert ffilled.shape == (4, 29)
+    assert ffilled[1, 1] == 0
+
+    dropped = StocksFeatures(ragged, missing=MISSING_DROP).diff_matrix()
+    assert dropped.shape == (4, 28)
+
+    aligned = StocksFeatures(ragged, missing=MISSING_ALIGN).diff_matrix()
+    assert aligned.shape == (4, 29)
+    assert np.isnan(aligned[1, 1]) and np.isnan(aligned[1, 2])
+
+
+def test_returns_matrix():
+    sf = StocksFeatures(make_prices())
+    prices = sf.price_matrix()
+    np.testing.assert_allclose(sf.returns_matrix(), (prices[1:] / prices[:-1] - 1).T)
+    np.testing.assert_allclose(sf.returns_matrix(log=True), np.log(prices[1:] / prices[:-1]).T)
+
+
+def test_ts_for_tickers_slices_index():
+    df = make_prices()
+    # Shuffle rows; the index must not depend on input order.
+    sf = StocksFeatures(df.sample(frac=1.0, random_state=3))
+    ts = sf.ts_for_tickers(['CCC', 'ZZZ'])['ts']
+
+    dates, closes = ts['CCC']
+    expected = df.loc[df.Ticker == 'CCC']
+    np.testing.assert_array_equal(dates, expected.Date.to_numpy())
+    np.testing.assert_allclose(closes, expected.Close.to_numpy())
+    assert len(ts['ZZZ'][0]) == 0
+
+    records = StocksFeatures.ts_records({'CCC': ts['CCC']})['CCC']
+    assert records[0] == [expected.Date.iloc[0].to_pydatetime(), expected.Close.iloc[0]]
+
+
+def test_rank_tickers_and_nearest_corr_use_neighbour_table():
+    tickers = [f'T{i:02d}' for i in range(12)]
+    sf = StocksFeatures(make_prices(tickers=tickers), neighbours=3)
+    corr = sf.pearson()
+
+    row = corr[sf.ix('T05')].copy()
+    row[sf.ix('T05')] = -np.inf
+    expected = [sf.name(i) for i in np.argsort(-row)]
+
+    assert [t for t, _ in sf.nearest_corr(corr, 'T05', n=3)] == expected[:3]
+    # Wider than the neighbour table falls back to the matrix row.
+    assert [t for t, _ in sf.nearest_corr(corr, 'T05', n=8)] == expected[:8]
+
+    others = ['T05', 'T11', 'T00', 'T07', 'UNKNOWN', 'T03']
+    ranked = sf.rank_tickers('T05', others, 3)
+    wanted = [t for t in expected if t in others][:3]
+    assert [t for t, _ in ranked] == wanted
+    for t, score in ranked:
+        assert score == corr[sf.ix('T05'), sf.ix(t)]
+    assert sf.rank_tickers('T05', ['T05'], 3) == []
+
+
+def test_cached_memory_maps_artifacts(tmp_path):
+    src = tmp_path / 'current.csv'
+    make_prices().to_csv(src, index=False)
+    out = tmp_path / 'artifacts'
+
+    built = StocksFeatures.cached(str(src), str(out))
+    loaded = StocksFeatures.cached(str(src), str(out))
+    assert built.df is not None and loaded.df is None
+    assert isinstance(loaded.pearson(), np.memmap)
+    np.testing.assert_allclose(loaded.pearson(), built.pearson())
+    assert loaded.names() == built.names()
+    assert loaded.rank_tickers('AAA', ['BBB', 'CCC'], 1) == built.rank_tickers('AAA', ['BBB', 'CCC'], 1)
+    np.testing.assert_array_equal(loaded.ts_for_tickers(['DDD'])['ts']['DDD'][1],
+                                  built.ts_for_tickers(['DDD'])['ts']['DDD'][1])
+
+    # New source data invalidates the artifacts.
+    make_prices(seed=1).to_csv(src, index=False)
+    assert StocksFeatures.cached(str(src), str(out)).df is not None
+
+
+def _cached_names(args):
+    src, out = args
+    return StocksFeatures.cached(src, out).names()
+
+
+def test_cached_survives_concurrent_rebuilds(tmp_path):
+    import multiprocessing
+
+    src = tmp_path / 'current.csv'
+    make_prices().to_csv(src, index=False)
+    out = tmp_path / 'artifacts'
+    with multiprocessing.get_context('fork').Pool(8) as pool:
+        for seed in range(3):
+            # Every worker finds the artifacts out of date at once.
+            make_prices(seed=seed).to_csv(src, index=False)
+            names = pool.map(_cached_names, [(str(src), str(out))] * 16)
+            assert names == [['AAA', 'BBB', 'CCC', 'DDD']] * 16
+    assert StocksFeatures.cached(str(src), str(out)).df is None
+    # Only the published build is left, plus nothing half-written.
+    assert sorted(p.name for p in out.iterdir() if p.is_dir()) == [open(out / 'CURRENT').read()]
+
+
+def test_read_parquet_projects_and_filters(tmp_path):
+    df = make_prices()
+    df['Date'] = df.Date.dt.tz_localize('UTC')
+    path = tmp_path / 'prices'
+    df.to_parquet(path, index=False, partition_cols=['Ticker'])
+    csv_path = tmp_path / 'current.csv'
+    df.to_csv(csv_path, index=False)
+
+    sf = StocksFeatures.read_prices(str(path), start='2025-01-10', tickers=['AAA', 'CCC'])
+    assert list(sf.df.columns) == ['Date', 'Ticker', 'Close']
+    assert sf.names() == ['AAA', 'CCC']
+    assert sf.df.Date.min() == pd.Timestamp('2025-01-10', tz='UTC')
+
+    fallback = StocksFeatures.read_prices(str(csv_path), start='2025-01-10', tickers=['AAA', 'CCC'])
+    np.testing.assert_allclose(fallback.pearson(), sf.pearson())
+
+
+def test_export_graph_chunked_matches_one_shot(tmp_path):
+    sf = StocksFeatures(make_prices(tickers=[f'T{i:02d}' for i in range(9)]))
+    corr = sf.pearson()
+
+    one_shot, chunked = tmp_path / 'one.csv', tmp_path / 'chunked.csv'
+    sf.export_graph(corr, 'pearson', one_shot, drop_threshold=0.1)
+    sf.export_graph(corr, 'pearson', chunked, drop_threshold=0.1, chunk_rows=2)
+    assert one_shot.read_text() == chunked.read_text()
+
+    edges = pd.read_csv(one_shot)
+    a, b = np.tril_indices(9, k=-1)
+    kept = corr[a, b] > 0.1
+    assert len(edges) == kept.sum()
+    np.testing.assert_allclose(edges.weight, corr[a, b][kept] * 1000)
+
+    sf.export_graph(corr, 'pearson', one_shot, drop_threshold=0.1, replace_drop=0)
+    assert len(pd.read_csv(one_shot)) == len(a)
+
+
+def test_sparse_graph_matches_export(tmp_path):
+    sf = StocksFeatures(make_prices(tickers=[f'T{i:02d}' for i in range(7)]))
+    path = tmp_path / 'pearson.csv'
+    sf.export_graph(sf.pearson(), 'pearson', path)
+    edges = pd.read_csv(path)
+
+    g = sf.sparse_graph(chunk_rows=3).toarray()
+    np.testing.assert_allclose(g, g.T)
+    for a, b, w in zip(edges.a, edges.b, edges.weight):
+        assert np.isclose(g[sf.ix(a), sf.ix(b)], w)
+    assert np.count_nonzero(g) == 2 * len(edges)
+
+
+def test_update_day_matches_full_recompute():
+    df = make_prices(tickers=('AAA', 'BBB', 'CCC', 'DDD', 'EEE'), days=50)
+    # BBB misses a day after the initial window.
+    df = df.drop(df.loc[df.Ticker == 'BBB'].index[40])
+    dates = sorted(df.Date.unique())
+
+    sf = StocksFeatures(df.loc[df.Date < dates[30]].reset_index(drop=True))
+    sf.pearson()
+    sf.update(df.loc[df.Date >= dates[30]])
+
+    window = df.loc[df.Date >= dates[20]].reset_index(drop=True)
+    fresh = StocksFeatures(window)
+    np.testing.assert_array_equal(sf.dates(), fresh.dates())
+    np.testing.assert_allclose(sf.pearson(), fresh.pearson(), atol=1e-10)
+    assert [t for t, _ in sf.nearest_corr(sf.pearson(), 'AAA', 3)] == \
+        [t for t, _ in fresh.nearest_corr(fresh.pearson(), 'AAA', 3)]
+    for t in ('AAA', 'BBB'):
+        np.testing.assert_array_equal(sf.ts_for_tickers([t])['ts'][t][1],
+                                      fresh.ts_for_tickers([t])['ts'][t][1])
+
+
+def test_correlation_kernels_match_scipy():
+    from scipy import stats
+    from features.kernels import KENDALL, LEDOIT_WOLF, SPEARMAN
+
+    df = make_prices(tickers=('AAA', 'BBB', 'CCC', 'DDD', 'EEE'), days=40)
+    sf = StocksFeatures(df)
+    dm = sf.diff_matrix()
+    # A tie, so spearman and kendall have to average / skip it.
+    dm[0, 3] = dm[0, 4]
+
+    np.testing.assert_allclose(sf.pearson_features(), np.corrcoef(dm), atol=1e-12)
+    np.testing.assert_allclose(sf.spearman_features(), stats.spearmanr(dm, axis=1).statistic,
+                               atol=1e-12)
+    kendall = sf.correlation(KENDALL)
+    for a in range(len(dm)):
+        for b in range(len(dm)):
+            assert abs(kendall[a, b] - stats.kendalltau(dm[a], dm[b]).statistic) < 1e-12
+
+    lw = sf.correlation(LEDOIT_WOLF)
+    np.testing.assert_allclose(np.diag(lw), 1)
+    assert (np.abs(lw) <= np.abs(sf.pearson()) + 1e-12).all()
+    assert sf.correlation(SPEARMAN, dtype=np.float32).dtype == np.float32
+
+
+def test_kendall_is_the_same_in_small_chunks(monkeypatch):
+    from scipy import stats
+    from features import kernels
+
+    dm = make_prices(tickers=('AAA', 'BBB', 'CCC'), days=30)
+    dm = StocksFeatures(dm).diff_matrix()
+    whole = kernels.CorrelationKernel(dm).kendall()
+    # Small enough that most chunks hold a single observation's pairs.
+    monkeypatch.setattr(kernels, 'KENDALL_CHUNK_BYTES', 3 * 8 * 5)
+    np.testing.assert_allclose(kernels.CorrelationKernel(dm).kendall(), whole, atol=1e-12)
+
+    # Longer series are cut to their latest observations.
+    monkeypatch.setattr(kernels, 'KENDALL_MAX_OBSERVATIONS', 12)
+    latest = kernels.CorrelationKernel(dm).kendall()
+    np.testing.assert_allclose(latest, kernels.CorrelationKernel(dm[:, -12:]).kendall())
+    assert abs(latest[0, 1] - stats.kendalltau(dm[0, -12:], dm[1, -12:]).statistic) < 1e-12
+
+
+def test_windows_match_corrcoef_per_window():
+    df = make_prices(tickers=('AAA', 'BBB', 'CCC', 'DDD'), days=60)
+    sf = StocksFeatures(df.drop(df.loc[df.Ticker == 'CCC'].index[10]), missing=MISSING_ALIGN)
+    dm = sf.diff_matrix()
+
+    cw = sf.windows(windows=(10, 25, 100), stride=7)
+    assert cw.tensor.dtype == np.float32
+    assert cw.lengths() == [10, 25]
+    for i, (start, end) in enumerate(cw.spans.tolist()):
+        np.testing.assert_allclose(cw.view(i), np.corrcoef(dm[:, start:end]), atol=1e-5)
+    # CCC's gap falls inside the earliest windows.
+    assert np.isnan(cw.view(cw.find(25, end=31))[2]).all()
+    assert cw.label(cw.find(10))[1] == sf.dates()[-1]
+
+    last = cw.view(cw.find(10))
+    ranked = sf.rank_tickers('AAA', ['BBB', 'CCC', 'DDD'], 2, corr=last)
+    assert [t for t, _ in ranked] == [sf.name(i + 1) for i in np.argsort(-last[0, 1:])[:2]]
+
+
+def test_tiled_correlation_matches_dense(tmp_path):
+    tickers = [f'T{i:02d}' for i in range(12)]
+    sf = StocksFeatures(make_prices(tickers=tickers, days=40))
+    dense = sf.pearson()
+
+    # A tiny budget forces one row per panel.
+    out = sf.tiled(k=3, threshold=0.1, out=str(tmp_path / 'corr.npy'), workers=2, budget=1)
+    np.testing.assert_allclose(out['matrix'], dense, atol=1e-5)
+    np.testing.assert_array_equal(out['nbr_ids'], sf._nbr_ids[:, :3])
+    a, b, corr = out['edges']
+    ea, eb, _ = sf._lower_edges(dense, 0, len(tickers), 0.1)
+    assert list(zip(a, b)) == list(zip(ea, eb))
+
+    sf.export_tiled_graph('pearson', str(tmp_path / 'tiled.csv'), workers=1)
+    sf.export_graph(dense, 'pearson', str(tmp_path / 'dense.csv'))
+    tiled = pd.read_csv(tmp_path / 'tiled.csv')
+    full = pd.read_csv(tmp_path / 'dense.csv')
+    assert (tiled[['a', 'b']] == full[['a', 'b']]).all().all()
+    np.testing.assert_allclose(tiled.weight, full.weight, atol=1e-2)
+
+    # Every edge without a threshold; replacing dropped edges needs them all.
+    sf.export_tiled_graph('pearson', str(tmp_path / 'all.csv'), drop_threshold=None, workers=1)
+    sf.export_graph(dense, 'pearson', str(tmp_path / 'dense.csv'), drop_threshold=None)
+    tiled = pd.read_csv(tmp_path / 'all.csv')
+    assert len(tiled) == len(tickers) * (len(tickers) - 1) // 2
+    assert (tiled[['a', 'b']] == pd.read_csv(tmp_path / 'dense.csv')[['a', 'b']]).all().all()
+    try:
+        sf.export_tiled_graph('pearson', str(tmp_path / 'x.csv'), replace_drop=0, workers=1)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_nearest_corr_never_returns_the_target():
+    sf = StocksFeatures(make_prices())
+    nearest = sf.nearest_corr(sf.pearson(), 'AAA', n=100)
+    assert [t for t, _ in nearest] == [t for t, _ in nearest if t != 'AAA']
+    assert len(nearest) == 3 and all(np.isfinite(s) for _, s in nearest)
@@ -0,0 +1,136 @@
+import fetch_stock_prices as fsp
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_limits_rate():
+    clock = FakeClock()
+    bucket = fsp.TokenBucket(rate=2, capacity=1, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        bucket.acquire()
+    # One token up front, then one every half second.
+    assert abs(clock.now - 2.0) < 1e-9
+
+
+def test_retry_backs_off_then_succeeds():
+    calls, waits = [], []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError('rate limited')
+        return 'ok'
+
+    assert fsp.retry(flaky, attempts=3, backoff=1, sleep=waits.append) == 'ok'
+    assert len(waits) == 2 and waits[1] > waits[0] / 3
+
+
+class FlakySource(fsp.FakeSource):
+    def __init__(self):
+        super().__init__()
+        self.failed = set()
+
+    def info(self, ticker):
+        if ticker not in self.failed:
+            self.failed.add(ticker)
+            raise IOError('timeout')
+        return super().info(ticker)
+
+
+def test_incomplete_sources_fail_when_constructed():
+    class HistoryOnly(fsp.PriceSource):
+        def history(self, tickers, start, end):
+            return {}
+
+    try:
+        HistoryOnly()
+        assert False
+    except TypeError:
+        pass
+
+
+def test_write_stocks_from_fake_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(fsp, 'BACKOFF_SECONDS', 0)
+    tickers = [f'T{i:02d}' for i in range(7)]
+    source = FlakySource()
+    limiter = fsp.TokenBucket(rate=1000, capacity=1000)
+    path = fsp.write_stocks(tickers, 30, str(tmp_path / 'current.csv'), source=source,
+                            workers=3, limiter=limiter)
+
+    import pandas as pd
+    df = pd.read_csv(path)
+    assert sorted(df.Ticker.unique()) == tickers
+    assert (df['Short Name'] == df.Ticker + ' Inc.').all()
+    # History was fetched in one batch; every info call was retried once.
+    assert source.calls == 1 + len(tickers)
+
+
+def test_refresh_stocks_fetches_only_the_delta(tmp_path):
+    from datetime import datetime, timedelta, UTC
+
+    tickers = ['AAA', 'BBB', 'CCC']
+    prices, meta = str(tmp_path / 'prices'), str(tmp_path / 'metadata.parquet')
+    limiter = fsp.TokenBucket(rate=1000, capacity=1000)
+    day = datetime(2025, 3, 3, 22, tzinfo=UTC)
+
+    source = fsp.FakeSource()
+    _, rows = fsp.refresh_stocks(tickers, 30, prices, meta, source=source,
+                                 limiter=limiter, today=day)
+    assert source.calls == 1 + len(tickers)
+
+    # A week later: one history range, no metadata, and a dropped ticker.
+    source = fsp.FakeSource()
+    later = day + timedelta(days=7)
+    _, new = fsp.refresh_stocks(tickers[:2], 30, prices, meta, source=source,
+                                limiter=limiter, today=later)
+    assert source.calls == 1 and new == 2 * 5
+
+    store = fsp.read_store(prices)
+    assert sorted(store.Ticker.unique()) == tickers[:2]
+    assert store.Date.min() >= fsp.pd.Timestamp(later - timedelta(days=30)).normalize()
+    # Same rows as fetching the whole window from scratch.
+    full, _ = fsp.fetch_stocks(tickers[:2], store.Date.min().strftime('%Y-%m-%d'),
+                               later.strftime('%Y-%m-%d'), source=fsp.FakeSource(),
+                               limiter=limiter, info_tickers=[])
+    aaa = store[store.Ticker == 'AAA'].sort_values('Date')
+    assert fsp.np.allclose(aaa.Close, full['AAA'].Close)
+    assert sorted(fsp.read_metadata(meta).Ticker) == tickers[:2]
+
+
+def test_refresh_stocks_leaves_unchanged_partitions_alone(tmp_path):
+    import os
+    from datetime import datetime, UTC
+
+    tickers = ['AAA', 'BBB', 'CCC']
+    prices, meta = str(tmp_path / 'prices'), str(tmp_path / 'metadata.parquet')
+    limiter = fsp.TokenBucket(rate=1000, capacity=1000)
+    day = datetime(2025, 3, 3, 22, tzinfo=UTC)
+
+    def files():
+        return {os.path.join(root, f): os.stat(os.path.join(root, f)).st_mtime_ns
+                for root, _, names in os.walk(prices) for f in names}
+
+    fsp.refresh_stocks(tickers, 30, prices, meta, source=fsp.FakeSource(),
+                       limiter=limiter, today=day)
+    stored, meta_mtime = files(), os.stat(meta).st_mtime_ns
+
+    # Again the same day: nothing new, nothing written.
+    _, new = fsp.refresh_stocks(tickers, 30, prices, meta, source=fsp.FakeSource(),
+                                limiter=limiter, today=day)
+    assert new == 0
+    assert files() == stored
+    assert os.stat(meta).st_mtime_ns == meta_mtime
+
+    # Dropping a ticker only removes its partition.
+    fsp.refresh_stocks(tickers[:2], 30, prices, meta, source=fsp.FakeSource(),
+                       limiter=limiter, today=day)
+    assert files() == {f: m for f, m in stored.items() if 'Ticker=CCC' not in f}
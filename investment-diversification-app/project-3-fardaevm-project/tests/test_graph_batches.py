@@ -0,0 +1,81 @@
+from threading import Lock
+from time import sleep
+
+from graph import (
+    Session,
+    batched,
+)
+
+
+class FakeNeoSession(object):
+    '''
+    Stands in for a neo4j session; records every batch written.
+    '''
+    def __init__(self, driver):
+        self.driver = driver
+
+    def execute_write(self, fn, query, rows):
+        sleep(0.001)
+        self.driver.written(rows)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeDriver(object):
+    '''
+    Counts the batches read from the rows but not written yet.
+    '''
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.sizes = []
+        self.read = 0
+        self.held = 0
+        self.max_held = 0
+        self._lock = Lock()
+
+    def session(self, database=None):
+        return FakeNeoSession(self)
+
+    def rows(self, n):
+        for i in range(n):
+            with self._lock:
+                if self.read % self.batch_size == 0:
+                    self.held += 1
+                    self.max_held = max(self.max_held, self.held)
+                self.read += 1
+            yield {'ticker': f'T{i}'}
+
+    def written(self, rows):
+        with self._lock:
+            self.sizes.append(len(rows))
+            self.held -= 1
+
+
+def test_batched_sizes():
+    assert [len(b) for b in batched(range(7), 3)] == [3, 3, 1]
+    assert list(batched([], 3)) == []
+
+
+def test_load_batches_in_one_session():
+    driver = FakeDriver(batch_size=4)
+    session = Session(None, driver=driver)
+    assert session.load_batches('query', driver.rows(10), batch_size=4) == 10
+    assert driver.sizes == [4, 4, 2]
+    assert driver.max_held == 1
+
+
+def test_load_batches_bounds_the_batches_in_flight():
+    workers = 3
+    driver = FakeDriver(batch_size=5)
+    session = Session(None, driver=driver)
+    sent = session.load_batches('query', driver.rows(203), batch_size=5, workers=workers)
+    assert sent == 203
+    assert sorted(driver.sizes) == [3] + [5] * 40
+    assert driver.max_held <= 2 * workers
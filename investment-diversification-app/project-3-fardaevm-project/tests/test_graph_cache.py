@@ -0,0 +1,59 @@
+import graph
+from graph.cache import LRUCache
+
+
+class FakeSession(object):
+    '''
+    Stands in for graph.Session; counts GDS calls.
+    '''
+    def __init__(self, version='v1'):
+        self.version = version
+        self.streamed = 0
+
+    def graph_version(self):
+        return self.version
+
+    def stream_personalized_pagerank(self, ticker, top_n, *args):
+        self.streamed += 1
+        return [{'ticker': f'{ticker}{i}', 'score': 1 / (i + 1)} for i in range(top_n)]
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.get('b', 'missing') == 'missing'
+
+
+def test_cached_personalized_pagerank_skips_gds_on_repeat():
+    graph.PPR_CACHE.clear()
+    graph.GRAPH_VERSION.invalidate()
+    sess = FakeSession()
+    ppr = graph.Session.cached_personalized_pagerank
+
+    assert len(ppr(sess, 'AAPL', top_n=3)) == 3
+    assert [r['ticker'] for r in ppr(sess, 'AAPL', top_n=5)] == [f'AAPL{i}' for i in range(5)]
+    assert sess.streamed == 1
+
+    # A new graph build is a new cache key.
+    sess.version = 'v2'
+    graph.GRAPH_VERSION.invalidate()
+    ppr(sess, 'AAPL', top_n=3)
+    assert sess.streamed == 2
+
+
+def test_lru_cache_bounds_memory():
+    cache = LRUCache(maxsize=10, maxbytes=10)
+    cache.put('a', b'xxxx')
+    cache.put('b', b'xxxx')
+    cache.get('a')
+    cache.put('c', b'xxxx')
+    assert 'b' not in cache and 'a' in cache and cache.nbytes == 8
+    cache.put('a', b'x')
+    assert cache.nbytes == 5
+    cache.put('huge', b'x' * 11)
+    assert 'huge' not in cache and len(cache) == 2
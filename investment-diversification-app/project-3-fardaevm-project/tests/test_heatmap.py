@@ -0,0 +1,47 @@
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'code', 'app'))
+
+from heatmap import (
+    colorize,
+    encode_png,
+    num_tiles,
+    tile_values,
+)
+
+
+def test_tiles_cover_the_reordered_matrix():
+    rng = np.random.default_rng(0)
+    corr = np.corrcoef(rng.normal(size=(10, 30)))
+    order = rng.permutation(10)
+    full = corr[np.ix_(order, order)]
+
+    assert num_tiles(10, step=1, size=4) == 3
+    np.testing.assert_allclose(tile_values(corr, order, 2, 1, size=4), full[8:, 4:8], atol=1e-6)
+
+    # 3 x 3 blocks, the last one ragged.
+    down = tile_values(corr, order, 0, 0, step=3, size=4)
+    assert down.shape == (4, 4)
+    np.testing.assert_allclose(down[1, 2], full[3:6, 6:9].mean(), atol=1e-6)
+    np.testing.assert_allclose(down[3, 3], full[9, 9], atol=1e-6)
+
+
+def test_png_holds_the_colours():
+    values = np.array([[-1, 0], [1, np.nan]], dtype=np.float32)
+    png = encode_png(colorize(values))
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    assert struct.unpack('>II', png[16:24]) == (2, 2)
+
+    idat = png.index(b'IDAT')
+    size = struct.unpack('>I', png[idat - 4:idat])[0]
+    raw = np.frombuffer(zlib.decompress(png[idat + 4:idat + 4 + size]), dtype=np.uint8)
+    rows = raw.reshape(2, 7)[:, 1:].reshape(2, 2, 3)
+    assert rows[0, 0].tolist() == [33, 102, 172]
+    assert rows[0, 1].tolist() == [247, 247, 247]
+    assert rows[1, 0].tolist() == [178, 24, 43]
+    assert rows[1, 1].tolist() == [200, 200, 200]
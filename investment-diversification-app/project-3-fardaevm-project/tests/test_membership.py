@@ -0,0 +1,54 @@
+from features import StocksFeatures
+from graph import GraphVersion
+from graph.membership import (
+    MembershipIndex,
+    Memberships,
+)
+
+
+class FakeSession(object):
+    '''
+    Stands in for graph.Session; counts get_groups round trips.
+    '''
+    def __init__(self):
+        self.version = 'v1'
+        self.loads = 0
+
+    def graph_version(self):
+        return self.version
+
+    def get_groups(self, ticker, nproperty='community'):
+        self.loads += 1
+        return [[i % 3, f'T{i}'] for i in range(8)]
+
+
+def test_grouped_matches_collect_groups():
+    sess = FakeSession()
+    index = MembershipIndex(properties=['community'], version=GraphVersion(ttl=0))
+    m = index.get(sess)
+
+    expected = StocksFeatures.collect_groups('T4', sess.get_groups('T4'), 5)
+    assert m.grouped('T4', 'community') == expected
+    assert m.similar('T4', 'community') == ['T1', 'T4', 'T7']
+    assert m.similar('NOPE', 'community') == []
+
+
+def test_reloads_only_on_new_graph_version():
+    sess = FakeSession()
+    index = MembershipIndex(properties=['community'], version=GraphVersion(ttl=0))
+    first = index.get(sess)
+    assert index.get(sess) is first
+    assert sess.loads == 1
+
+    index.get(sess, 'leiden_community')
+    assert sess.loads == 2
+
+    sess.version = 'v2'
+    assert index.get(sess) is not first
+    assert sess.loads == 3
+
+
+def test_tickers_without_a_community_have_no_similar():
+    m = Memberships({'leiden_community': [[0, 'A'], [None, 'B'], [None, 'C'], [0, 'D']]})
+    assert m.similar('B', 'leiden_community') == []
+    assert m.similar('A', 'leiden_community') == ['A', 'D']
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import minimum_spanning_tree
+
+from features import (
+    MISSING_ALIGN,
+    StocksFeatures,
+)
+from mst import (
+    KNN,
+    MST,
+    knn_pairs,
+    log_return_corr,
+    mst_edges,
+    mst_knn_edges,
+)
+
+
+def make_corr(n=12, seed=0):
+    x = np.random.default_rng(seed).normal(size=(n, 40))
+    return np.corrcoef(x), [f'T{i:02d}' for i in range(n)]
+
+
+def test_mst_edges_match_dense_tree():
+    corr, names = make_corr()
+    dist = 2 * (1 - corr)
+    np.fill_diagonal(dist, np.inf)
+    dense = minimum_spanning_tree(dist).toarray()
+    rows, cols = np.nonzero(dense)
+
+    edges = mst_edges(corr, names)
+    assert list(edges.columns) == ['a', 'b', 'weight', 'relationship']
+    assert list(zip(edges.a, edges.b)) == [(names[i], names[j]) for i, j in zip(rows, cols)]
+    np.testing.assert_allclose(edges.weight, 1 - dense[rows, cols] / 2)
+
+
+def test_mst_knn_union_has_each_pair_once():
+    corr, names = make_corr()
+    edges = mst_knn_edges(corr, names, k=3)
+    pairs = [frozenset(p) for p in zip(edges.a, edges.b)]
+    assert len(pairs) == len(set(pairs))
+    assert (edges.relationship == MST).sum() == len(names) - 1
+    assert (edges.relationship == KNN).any()
+    for a, b, w in zip(edges.a, edges.b, edges.weight):
+        assert w == corr[names.index(a), names.index(b)]
+
+
+def test_knn_pairs_skip_self_loops_when_k_covers_everyone():
+    corr, _ = make_corr(n=5)
+    rows, cols = knn_pairs(corr, k=10)
+    assert len(rows) == 5 * 4 and not (rows == cols).any()
+
+
+def test_log_return_corr_leaves_out_tickers_with_gaps():
+    rng = np.random.default_rng(1)
+    dates = pd.date_range('2025-01-01', periods=30, tz='UTC')
+    closes = pd.DataFrame(100 * np.exp(rng.normal(0, 0.01, size=(30, 3)).cumsum(axis=0)),
+                          index=dates, columns=['AAA', 'BBB', 'CCC'])
+    df = closes.rename_axis('Date').reset_index().melt('Date', var_name='Ticker', value_name='Close')
+    df = df.drop(df.loc[df.Ticker == 'BBB'].index[10]).reset_index(drop=True)
+
+    corr, names = log_return_corr(StocksFeatures(df, missing=MISSING_ALIGN))
+    assert names == ['AAA', 'CCC']
+    expected = np.log(closes[names] / closes[names].shift(1)).dropna().corr()
+    np.testing.assert_allclose(corr, expected.to_numpy())
@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'code', 'app'))
+
+from flask import (
+    Flask,
+    make_response,
+)
+
+from graph.cache import LRUCache
+from responses import cached_response
+from service import ServiceError
+
+
+class FakeService(object):
+    def __init__(self):
+        self.version = 1
+
+    def data_version(self):
+        return self.version
+
+
+def make_app():
+    app = Flask(__name__)
+    service = FakeService()
+    cache = LRUCache(16)
+    builds = []
+
+    @app.route('/<string:name>')
+    def index(name):
+        def build():
+            builds.append(name)
+            if name == 'bad':
+                raise ServiceError('unknown')
+            return make_response(f'{name} v{service.version}', 200)
+
+        return cached_response(service, ('index', name), build, vary='Accept', cache=cache)
+
+    return app.test_client(), service, builds
+
+
+def test_cached_responses_revalidate_with_etags():
+    client, service, builds = make_app()
+    first = client.get('/a')
+    assert first.status_code == 200 and first.get_data(as_text=True) == 'a v1'
+    etag = first.headers['ETag']
+    assert first.headers['Vary'] == 'Accept'
+
+    again = client.get('/a', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.headers['Vary'] == 'Accept'
+    assert client.get('/a').headers['ETag'] == etag
+    assert builds == ['a']
+
+    # A new data version retires the cached body and its ETag.
+    service.version = 2
+    bumped = client.get('/a', headers={'If-None-Match': etag})
+    assert bumped.status_code == 200 and bumped.get_data(as_text=True) == 'a v2'
+    assert bumped.headers['ETag'] != etag
+    assert builds == ['a', 'a']
+
+
+def test_errors_are_not_cached():
+    client, _, builds = make_app()
+    for _ in range(2):
+        response = client.get('/bad')
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'unknown'}
+        assert 'ETag' not in response.headers
+    assert builds == ['bad', 'bad']
@@ -0,0 +1,185 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'code', 'app'))
+
+from features import StocksFeatures
+from graph.membership import Memberships
+import service as service_module
+from service import (
+    COLUMNAR_MIMETYPE,
+    ServiceError,
+    SimilarityService,
+    columnar,
+    encode_columnar,
+    prefers_columnar,
+)
+from test_features import make_prices
+
+
+def make_service():
+    tickers = [f'T{i}' for i in range(6)]
+    df = make_prices(tickers=tickers, days=20)
+    # T3 misses its second day.
+    df = df.drop(df.loc[df.Ticker == 'T3'].index[1])
+    sf = StocksFeatures(df.reset_index(drop=True))
+    groupings = [[i % 2, t] for i, t in enumerate(tickers)]
+    memberships = Memberships({'community': groupings, 'leiden_community': groupings})
+    return sf, SimilarityService(sf, lambda prop=None: memberships, None)
+
+
+def test_similar_matches_the_api_format():
+    sf, service = make_service()
+    result = service.similar('t1', 'LOUVAIN', 2)
+    assert result.ticker == 'T1'
+    assert result.rank == sf.rank_tickers('T1', ['T1', 'T3', 'T5'], 2)
+    assert result.to_json()['ts'] == sf.ts_records(
+        sf.ts_for_tickers([t for t, _ in result.rank] + ['T1'])['ts'])
+
+    try:
+        service.similar('NOPE')
+        assert False
+    except ServiceError as e:
+        assert str(e) == 'unknown stock ticker'
+
+
+def test_chart_labels_are_cached_per_version():
+    sf, service = make_service()
+    labels, data = service.chart(service.similar('T1', n=2).series)
+    assert [list(d) for d in data] == [['T1'], ['T3'], ['T5']]
+    assert labels[:2] == ['01/02/25', '01/03/25']
+    # T3 has no 01/03/25 point.
+    assert [p[0] for p in data[1]['T3']][:2] == ['01/02/25', '01/06/25']
+    assert data[0]['T1'][0][1] == sf.ts_for_tickers(['T1'])['ts']['T1'][1][0]
+    assert service.labels() is service.labels()
+
+    cached, version = service.labels(), service.data_version()
+    sf.update_day('2025-01-30', {t: 100.0 for t in sf.names()})
+    assert service.labels() is not cached
+    assert service.data_version() != version
+    assert service.labels()(np.array(['2025-01-30'], dtype='datetime64[ns]'))[0] == '01/30/25'
+
+
+def test_groups_put_the_target_group_first():
+    _, service = make_service()
+    groups = service.groups('T2', 'leiden', 1)
+    assert [g.group for g in groups] == [0, 1]
+    assert groups[0].ticker == 'T2' and groups[1].ticker is None
+    assert 'ticker' not in groups[1].group_json()
+
+
+def test_columnar_sends_the_date_axis_once(monkeypatch):
+    import json
+
+    _, service = make_service()
+    groups = service.groups('T2', 'louvain', 2)
+    payload = columnar(groups, grouped=True)
+    assert len(payload['dates']) == 20 and payload['dates'][0] == '2025-01-02T00:00:00Z'
+
+    fast = json.loads(encode_columnar(payload))
+    monkeypatch.setattr(service_module, 'orjson', None)
+    assert json.loads(encode_columnar(payload)) == fast
+
+    for group, blob in zip(groups, fast['groups']):
+        assert blob['rank'] == [list(r) for r in group.rank]
+        for ticker, pairs in group.series.records().items():
+            closes = dict(zip(fast['dates'], blob['ts'][ticker]))
+            for date, close in pairs:
+                assert closes[date.strftime('%Y-%m-%dT%H:%M:%SZ')] == close
+    # T3 has no close on its second day.
+    t3 = [b for b in fast['groups'] if 'T3' in b['ts']][0]['ts']['T3']
+    assert t3[1] is None
+
+
+def test_heatmap_order_groups_by_community():
+    sf, service = make_service()
+    order, groups = service.heatmap_order()
+    assert [sf.name(ix) for ix in order] == ['T0', 'T2', 'T4', 'T1', 'T3', 'T5']
+    assert groups == [[0, 0, 3], [1, 3, 6]]
+    assert service.correlation('Spearman') is service.correlation('spearman')
+
+
+def test_heatmap_order_puts_unassigned_tickers_last():
+    sf, _ = make_service()
+    groupings = [[None if i in (1, 4) else i % 2, t] for i, t in enumerate(sf.names())]
+    memberships = Memberships({'community': groupings})
+    service = SimilarityService(sf, lambda prop=None: memberships, None)
+    order, groups = service.heatmap_order()
+    assert [sf.name(ix) for ix in order] == ['T0', 'T2', 'T3', 'T5', 'T1', 'T4']
+    assert groups == [[0, 0, 2], [1, 2, 4], [None, 4, 6]]
+
+
+def test_columnar_is_only_served_when_asked_for():
+    from flask import Flask, request
+
+    app = Flask(__name__)
+
+    @app.route('/')
+    def index():
+        return 'columnar' if prefers_columnar(request.args, request.accept_mimetypes) else 'json'
+
+    client = app.test_client()
+
+    def get(accept=None, query=''):
+        headers = {'Accept': accept} if accept is not None else {}
+        return client.get('/' + query, headers=headers).get_data(as_text=True)
+
+    assert get() == 'json'
+    assert get('*/*') == 'json'
+    assert get('text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8') == 'json'
+    assert get(f'application/json, {COLUMNAR_MIMETYPE}') == 'json'
+    assert get(COLUMNAR_MIMETYPE) == 'columnar'
+    assert get(f'{COLUMNAR_MIMETYPE}, application/json;q=0.5') == 'columnar'
+    assert get(f'{COLUMNAR_MIMETYPE}, */*;q=0.1') == 'columnar'
+    assert get('*/*', '?format=columnar') == 'columnar'
+
+
+def test_heatmap_works_without_the_graph(monkeypatch):
+    sf, _ = make_service()
+    calls = []
+
+    def unavailable(*args):
+        calls.append(args)
+        raise IOError('neo4j is down')
+
+    service = SimilarityService(sf, unavailable, None, unavailable)
+    order, groups = service.heatmap_order()
+    assert [sf.name(ix) for ix in order] == sorted(sf.names())
+    assert groups == [[None, 0, len(sf.names())]]
+    assert service.data_version() == (sf.digest, sf.version, None, None)
+    # The failure is remembered instead of retried on every request.
+    service.heatmap_order()
+    assert len(calls) == 1
+    monkeypatch.setattr(service_module, 'GRAPH_RETRY_SECONDS', 0)
+    service.data_version()
+    assert len(calls) == 2
+
+    assert service.check_step(None) == 1
+    assert service.check_step('3') == 3
+    for step in ('x', '0', '-2', '1.5'):
+        try:
+            service.check_step(step)
+            assert False, step
+        except ServiceError:
+            pass
+
+
+def test_concurrent_tiles_compute_each_measure_once():
+    from concurrent.futures import ThreadPoolExecutor
+
+    sf, service = make_service()
+    computed = []
+    correlation = sf.correlation
+
+    def counting(method):
+        computed.append(method)
+        return correlation(method)
+
+    sf.correlation = counting
+    methods = ['spearman', 'kendall'] * 16
+    with ThreadPoolExecutor(8) as pool:
+        matrices = list(pool.map(service.correlation, methods))
+    assert sorted(computed) == ['kendall', 'spearman']
+    assert all(m is matrices[i % 2] for i, m in enumerate(matrices))
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'code', 'app'))
+
+from snapshot import (
+    Snapshot,
+    SnapshotReloader,
+    source_stamp,
+    stamp_version,
+)
+
+
+class Source(object):
+    '''
+    Counts loads; `stamp` stands in for the data on disk.
+    '''
+    def __init__(self):
+        self.stamp = 1
+        self.loads = 0
+        self.fail = False
+
+    def load(self, stamp):
+        if self.fail:
+            raise IOError('half-written file')
+        self.loads += 1
+        return Snapshot(f'features {stamp}', None, None, stamp)
+
+
+def test_reload_swaps_only_when_the_data_changes():
+    source = Source()
+    reloader = SnapshotReloader(source.load, lambda: source.stamp, interval=0)
+    first = reloader.current()
+    assert not reloader.reload() and reloader.current() is first
+
+    source.stamp = 2
+    assert reloader.reload()
+    # Whoever held the old snapshot keeps a consistent view.
+    assert first.features == 'features 1'
+    assert reloader.current().features == 'features 2' and source.loads == 2
+
+
+def test_background_reload_survives_failures():
+    source = Source()
+    reloader = SnapshotReloader(source.load, lambda: source.stamp, interval=0.01)
+    first = reloader.current()
+    source.fail, source.stamp = True, 2
+    reloader.start()
+    try:
+        time.sleep(0.1)
+        assert reloader.current() is first
+        source.fail = False
+        deadline = time.monotonic() + 5
+        while reloader.current() is first and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert reloader.current().stamp == 2
+    finally:
+        reloader.stop()
+
+
+def test_source_stamp_follows_files(tmp_path):
+    path = tmp_path / 'prices'
+    path.mkdir()
+    (path / 'a.parquet').write_bytes(b'x')
+    stamp = source_stamp(str(path), str(tmp_path / 'missing'))
+    assert stamp == source_stamp(str(path), str(tmp_path / 'missing'))
+    (path / 'b.parquet').write_bytes(b'y')
+    assert source_stamp(str(path)) != stamp
+
+
+def test_swapping_only_the_pagerank_input_changes_the_data_version(tmp_path):
+    from service import SimilarityService
+    from test_service import make_service
+
+    sf, _ = make_service()
+    edges = tmp_path / 'pearson.csv'
+    edges.write_text('a,b,weight\nT0,T1,0.9\n')
+
+    def load(stamp):
+        top = edges.read_text().splitlines()[1].split(',')[1]
+        service = SimilarityService(sf, None, lambda ticker, n: [{'ticker': top, 'score': 1}],
+                                    version=stamp_version(stamp))
+        return Snapshot(sf, None, service, stamp)
+
+    reloader = SnapshotReloader(load, lambda: source_stamp(str(edges)), interval=0)
+    before = reloader.current().service
+    edges.write_text('a,b,weight\nT0,T2,0.95\n')
+    assert reloader.reload()
+    after = reloader.current().service
+    # Same prices, so only the snapshot's version tells the answers apart.
+    assert after.features.version == before.features.version
+    assert after.data_version() != before.data_version()
+    assert after.similar('T0', 'page_rank').series.tickers[0] == 'T2'